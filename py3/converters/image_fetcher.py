@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+#  Copyright (c) 2020 unfoldingWord
+#  http://creativecommons.org/licenses/MIT/
+#  See LICENSE file for details.
+#
+#  Contributors:
+#  Richard Mahn <rich.mahn@unfoldingword.org>
+
+"""
+Class for fetching the images (and logos) of a PDF build through a shared, content-addressed cache
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+
+
+class ImageFetcher(object):
+    """
+    Downloads files a few at a time, each worker thread keeping its own pooled HTTP session.
+
+    Every file downloaded is kept in the cache directory under the SHA-256 of its content (objects/ab/abcdef...),
+    with the URL's ETag and Last-Modified kept alongside (urls/<SHA-256 of the URL>.json),
+    so the cache can be shared by every language and every run: a cached URL is only revalidated,
+    and the same image at two URLs is stored once.
+    If there is a mirror directory, a file found there (by host and path, or else by file name) is used
+    instead of the network, e.g. for offline builds.
+    """
+
+    def __init__(self, cache_dir, mirror_dir=None, max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, logger=None):
+        self.cache_dir = cache_dir
+        self.mirror_dir = mirror_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.logger = logger or logging.getLogger()
+        self.local = threading.local()
+        os.makedirs(os.path.join(self.cache_dir, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, 'urls'), exist_ok=True)
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(max_retries=retry)
+            self.local.session = requests.Session()
+            self.local.session.mount('http://', adapter)
+            self.local.session.mount('https://', adapter)
+        return self.local.session
+
+    def get_object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def get_url_info_path(self, url):
+        return os.path.join(self.cache_dir, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get_url_info(self, url):
+        """
+        :return: the cache info for the URL ({'url', 'sha256', 'etag', 'last_modified'}),
+                    or None if it's not cached or its object is missing or corrupt
+        """
+        info_path = self.get_url_info_path(url)
+        if not os.path.isfile(info_path):
+            return None
+        try:
+            with open(info_path) as info_file:
+                info = json.load(info_file)
+        except ValueError:
+            return None
+        if info.get('url') != url or not self.is_object_ok(info.get('sha256', '')):
+            return None
+        return info
+
+    def is_object_ok(self, digest):
+        object_path = self.get_object_path(digest)
+        if not digest or not os.path.isfile(object_path):
+            return False
+        hasher = hashlib.sha256()
+        with open(object_path, 'rb') as object_file:
+            for block in iter(lambda: object_file.read(1024 * 1024), b''):
+                hasher.update(block)
+        return hasher.hexdigest() == digest
+
+    @staticmethod
+    def write_atomically(path, content, mode='wb'):
+        # Written to a temporary file first, so other runs sharing the cache never see part of a file
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as temp_file:
+                temp_file.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def add_object(self, content):
+        """
+        :return: the SHA-256 of the content, which is now in the cache
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self.get_object_path(digest)
+        if not os.path.isfile(object_path):
+            self.write_atomically(object_path, content)
+        return digest
+
+    def save_url_info(self, url, digest, etag=None, last_modified=None):
+        info = {'url': url, 'sha256': digest, 'etag': etag, 'last_modified': last_modified}
+        self.write_atomically(self.get_url_info_path(url), json.dumps(info), 'w')
+        return info
+
+    def get_mirror_path(self, url):
+        if not self.mirror_dir:
+            return None
+        parsed_url = urlparse(url)
+        for path in [os.path.join(self.mirror_dir, parsed_url.netloc, parsed_url.path.lstrip('/')),
+                     os.path.join(self.mirror_dir, os.path.basename(parsed_url.path))]:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get_cached(self, url):
+        """
+        Puts the URL's file in the cache if it isn't there or has changed
+        (keeping the cached file if the URL can't be revalidated)
+        :return: the SHA-256 of the file
+        """
+        mirror_path = self.get_mirror_path(url)
+        if mirror_path:
+            with open(mirror_path, 'rb') as mirror_file:
+                return self.add_object(mirror_file.read())
+        info = self.get_url_info(url)
+        headers = {}
+        if info and info.get('etag'):
+            headers['If-None-Match'] = info['etag']
+        if info and info.get('last_modified'):
+            headers['If-Modified-Since'] = info['last_modified']
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if not info:
+                raise
+            # A cached file is still good enough when it can't be revalidated
+            self.logger.warning(f'Unable to revalidate {url}, so using the cached copy: {e}')
+            return info['sha256']
+        if info and response.status_code == 304:
+            return info['sha256']
+        if info and not 200 <= response.status_code < 300:
+            self.logger.warning(f'Unable to revalidate {url} (HTTP {response.status_code}), so using the cached copy')
+            return info['sha256']
+        response.raise_for_status()
+        content = response.content
+        if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers \
+                and len(content) != int(response.headers['Content-Length']):
+            raise IOError(f'got {len(content)} of {response.headers["Content-Length"]} bytes')
+        digest = self.add_object(content)
+        self.save_url_info(url, digest, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return digest
+
+    def fetch(self, url, filepath):
+        """
+        Copies the file at the URL to filepath (through the cache)
+        :return: True if it did, False if it couldn't get the file (which is logged)
+        """
+        try:
+            digest = self.get_cached(url)
+            with open(self.get_object_path(digest), 'rb') as object_file:
+                self.write_atomically(filepath, object_file.read())
+        except (requests.RequestException, IOError) as e:
+            self.logger.error(f'Unable to fetch {url}: {e}')
+            return False
+        return True
+
+    def fetch_all(self, downloads):
+        """
+        Fetches max_workers files at a time
+        :param downloads: list of (url, filepath)
+        :return: list of the URLs it couldn't get
+        """
+        if not downloads:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda download: self.fetch(*download), downloads))
+        return [url for (url, filepath), ok in zip(downloads, results) if not ok]
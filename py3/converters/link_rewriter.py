@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+#  Copyright (c) 2020 unfoldingWord
+#  http://creativecommons.org/licenses/MIT/
+#  See LICENSE file for details.
+#
+#  Contributors:
+#  Richard Mahn <rich.mahn@unfoldingword.org>
+
+"""
+Class for rewriting the links of a whole HTML document with a chain of regex rules in one scan
+"""
+import re
+import heapq
+
+# How close two links have to be to be rewritten as one piece of the document
+MERGE_DISTANCE = 64
+
+
+class LinkRewriter(object):
+    """
+    Gives the same HTML as running re.sub() over the whole document for each rule in turn,
+    but only runs the rules over the pieces of the document that have links in them.
+
+    Each rule has a trigger, a regex for a bit of text on one line that every match of the rule contains
+    (e.g. 'rc://' for RC links). A scan for the triggers finds the links, and the rules are run
+    over the lines around them. A rule's matches must not run over the end of a line,
+    except inside a tag (e.g. <a\\nhref="...">), after a quote that's not in a tag, or inside [[...]].
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.triggers = []
+
+    def add_rule(self, pattern, repl, trigger, flags=0):
+        """
+        :param pattern: regex to replace, as for re.sub()
+        :param repl: replacement string or function, as for re.sub()
+        :param trigger: regex for text that every match of the pattern contains, e.g. r'[wW]\.' for 'www.'
+                        (it's quickest if it starts with a literal or a set of characters)
+        """
+        self.rules.append((re.compile(pattern, flags), repl, re.compile(trigger)))
+        self.triggers.append(trigger)
+
+    def rewrite(self, html):
+        if not self.rules:
+            return html
+        # Searching for each trigger on its own is much faster than searching for all of them with one regex
+        triggers = heapq.merge(*[re.finditer(trigger, html) for trigger in dict.fromkeys(self.triggers)],
+                               key=lambda match: match.start())
+        pieces = []
+        pos = 0
+        start = end = -1
+        for trigger in triggers:
+            if trigger.end() <= end:
+                continue
+            if start >= 0 and trigger.start() < end + MERGE_DISTANCE:
+                # Take in the links that follow closely, so the rules are run over fewer, bigger pieces
+                end = self.get_piece_end(html, end, trigger.end())
+                continue
+            if start >= 0:
+                pieces.append(html[pos:start])
+                pieces.append(self.rewrite_piece(html[start:end]))
+                pos = end
+            start = self.get_piece_start(html, pos, trigger.start())
+            end = self.get_piece_end(html, start, trigger.end())
+        if start >= 0:
+            pieces.append(html[pos:start])
+            pieces.append(self.rewrite_piece(html[start:end]))
+            pos = end
+        pieces.append(html[pos:])
+        return ''.join(pieces)
+
+    def rewrite_piece(self, piece):
+        for regex, repl, trigger_re in self.rules:
+            if trigger_re.search(piece):
+                piece = regex.sub(repl, piece)
+        return piece
+
+    @staticmethod
+    def is_boundary(html, start, pos):
+        """
+        :return: True if no rule can match over the end of the line at pos (the index of a newline),
+                    given that none can match over start
+        """
+        tag_end = html.rfind('>', start, pos)
+        if html.rfind('<', start, pos) > tag_end or html.rfind('"', start, pos) > tag_end:
+            return False
+        return html.rfind('[', start, pos) <= html.rfind(']', start, pos)
+
+    def get_piece_start(self, html, start, pos):
+        """
+        :return: the start of the last line at or before pos that starts a piece (the line keeps its newline),
+                    not going back past start
+        """
+        line_start = html.rfind('\n', start, pos)
+        while line_start > start and not self.is_boundary(html, start, line_start):
+            line_start = html.rfind('\n', start, line_start)
+        return max(line_start, start)
+
+    def get_piece_end(self, html, start, pos):
+        """
+        :return: the end of the first line at or after pos that ends a piece (the next line keeps the newline),
+                    where start is the start or end of a piece before pos
+        """
+        line_end = html.find('\n', pos)
+        while line_end >= 0 and not self.is_boundary(html, start, line_end):
+            line_end = html.find('\n', line_end + 1)
+        return len(html) if line_end < 0 else line_end
@@ -192,23 +192,22 @@ class ObsTnPdfConverter(PdfConverter):
 '''
         return obs_tn_html
 
-    def fix_links(self, html):
+    def add_link_rules(self, link_rewriter):
         # Changes references to chapter/frame in links
         # <a href="1/10">Text</a> => <a href="rc://obs-sn/help/obs/01/10">Text</a>
         # <a href="10-1">Text</a> => <a href="rc://obs-sn/help/obs/10/01">Text</a>
-        html = re.sub(r'href="(\d)/(\d+)"', r'href="0\1/\2"', html)  # prefix 0 on single-digit chapters
-        html = re.sub(r'href="(\d+)/(\d)"', r'href="\1/0\2"', html)  # prefix 0 on single-digit frames
-        html = re.sub(r'href="(\d\d)/(\d\d)"', fr'href="rc://{self.lang_code}/obs-tn/help/\1/\2"', html)
+        link_rewriter.add_rule(r'href="(\d)/(\d+)"', r'href="0\1/\2"', r'href="\d')  # prefix 0 on single-digit chapters
+        link_rewriter.add_rule(r'href="(\d+)/(\d)"', r'href="\1/0\2"', r'href="\d')  # prefix 0 on single-digit frames
+        link_rewriter.add_rule(r'href="(\d\d)/(\d\d)"', fr'href="rc://{self.lang_code}/obs-tn/help/\1/\2"', r'href="\d')
 
         # Changes references to chapter/frame that are just chapter/frame prefixed with a #
         # #1:10 => <a href="rc://en/obs/book/obs/01/10">01:10</a>
         # #10/1 => <a href="rc://en/obs/book/obs/10/01">10:01</a>
         # #10/12 => <a href="rc://en/obs/book/obs/10/12">10:12</a>
-        html = re.sub(r'#(\d)[:/-](\d+)', r'#0\1-\2', html)  # prefix 0 on single-digit chapters
-        html = re.sub(r'#(\d+)[:/-](\d)\b', r'#\1-0\2', html)  # prefix 0 on single-digit frames
-        html = re.sub(r'#(\d\d)[:/-](\d\d)', rf'<a href="rc://{self.lang_code}/obs-tn/help/\1/\2">\1:\2</a>', html)
-
-        return html
+        link_rewriter.add_rule(r'#(\d)[:/-](\d+)', r'#0\1-\2', r'#\d')  # prefix 0 on single-digit chapters
+        link_rewriter.add_rule(r'#(\d+)[:/-](\d)\b', r'#\1-0\2', r'#\d')  # prefix 0 on single-digit frames
+        link_rewriter.add_rule(r'#(\d\d)[:/-](\d\d)', rf'<a href="rc://{self.lang_code}/obs-tn/help/\1/\2">\1:\2</a>',
+                               r'#\d')
 
 
 if __name__ == '__main__':
@@ -18,29 +18,35 @@ import markdown2
 import shutil
 import subprocess
 import string
-import requests
 import sys
 import argparse
+import functools
 import jsonpickle
 import yaml
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Type
 from bs4 import BeautifulSoup
 from abc import abstractmethod
 from weasyprint import HTML, LOGGER
 from .resource import Resource, Resources
 from .rc_link import ResourceContainerLink
+from .link_rewriter import LinkRewriter
+from .image_fetcher import ImageFetcher
 from ..general_tools.file_utils import write_file, read_file, load_json_object
 
 DEFAULT_LANG_CODE = 'en'
 DEFAULT_OWNER = 'unfoldingWord'
 DEFAULT_TAG = 'master'
+DEFAULT_IMAGE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pdf_converter', 'images')
+DEFAULT_GIT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pdf_converter', 'git')
 LANGUAGE_FILES = {
     'fr': 'French-fr_FR.json',
     'en': 'English-en_US.json'
 }
 APPENDIX_LINKING_LEVEL = 1
 APPENDIX_RESOURCES = ['ta', 'tw']
+MAX_CLONE_WORKERS = 8
 
 
 class PdfConverter:
@@ -60,12 +66,15 @@ class PdfConverter:
         self.log_dir = None
         self.images_dir = None
         self.output_res_dir = None
+        self.image_fetcher = None
+        self.git_cache_dir = None
 
         self.bad_links = {}
         self.bad_highlights = {}
         self.rcs = {}
         self.appendix_rcs = {}
         self.all_rcs = {}
+        self.section_header_article_ids = set()  # articles whose first header becomes a section header
 
         self.html_file = None
         self.pdf_file = None
@@ -226,6 +235,24 @@ class PdfConverter:
         if not os.path.isdir(self.images_dir):
             os.makedirs(self.images_dir)
 
+        # Images are fetched through a cache shared by all languages and runs, or from a local mirror if given
+        image_cache_dir = DEFAULT_IMAGE_CACHE_DIR
+        if 'IMAGE_CACHE_DIR' in os.environ:
+            image_cache_dir = os.environ['IMAGE_CACHE_DIR']
+            self.logger.info(f'Using env var IMAGE_CACHE_DIR: {image_cache_dir}')
+        image_mirror_dir = None
+        if 'IMAGE_MIRROR_DIR' in os.environ:
+            image_mirror_dir = os.environ['IMAGE_MIRROR_DIR']
+            self.logger.info(f'Using env var IMAGE_MIRROR_DIR: {image_mirror_dir}')
+        self.image_fetcher = ImageFetcher(image_cache_dir, mirror_dir=image_mirror_dir, logger=self.logger)
+
+        # Repos are cloned from mirrors in a cache shared by all languages and runs (GIT_CACHE_DIR set to nothing
+        # turns it off, and then the clones are shallow)
+        self.git_cache_dir = DEFAULT_GIT_CACHE_DIR
+        if 'GIT_CACHE_DIR' in os.environ:
+            self.git_cache_dir = os.environ['GIT_CACHE_DIR']
+            self.logger.info(f'Using env var GIT_CACHE_DIR: {self.git_cache_dir}')
+
         self.save_dir = os.path.join(self.output_res_dir, 'save')
         if not os.path.isdir(self.save_dir):
             os.makedirs(self.save_dir)
@@ -272,16 +299,22 @@ class PdfConverter:
                 body_html += self.get_appendix_html(self.resources['ta'])
             if 'tw' in self.resources:
                 body_html += self.get_appendix_html(self.resources['tw'])
-            self.logger.info('Fixing links in body HTML...')
-            body_html = self.fix_links(body_html)
-            body_html = self._fix_links(body_html)
-            self.logger.info('Replacing RC links in body HTML...')
-            body_html = self.replace_rc_links(body_html)
+            self.logger.info('Fixing links and replacing RC links in body HTML...')
+            # Same as fix_links(), _fix_links() and then replace_rc_links(), but in one scan of the body
+            link_rewriter = LinkRewriter()
+            self.add_link_rules(link_rewriter)
+            self.add_url_link_rules(link_rewriter)
+            self.add_rc_link_rules(link_rewriter)
+            body_html = link_rewriter.rewrite(body_html)
             self.logger.info('Generating Contributors HTML...')
             body_html += self.get_contributors_html()
-            body_html = self.download_all_images(body_html)
+            # The body is parsed once for the header, image and TOC passes, and serialized once after them
+            body_soup = BeautifulSoup(body_html, 'html.parser')
+            self.make_soup_first_headers_section_headers(body_soup)
+            self.download_soup_images(body_soup)
             self.logger.info('Generating TOC HTML...')
-            body_html, toc_html = self.get_toc_html(body_html)
+            toc_html = self.get_soup_toc_html(body_soup)
+            body_html = str(body_soup)
 
             with open(os.path.join(self.converters_dir, 'templates/template.html')) as template_file:
                 html_template = string.Template(template_file.read())
@@ -415,15 +448,22 @@ class PdfConverter:
 
         self.logger.info(f'BAD HIGHLIGHTS file can be found at {save_file}')
 
+    def clone_resource(self, resource):
+        resource.clone(self.working_dir, self.git_cache_dir)
+
     def setup_resource(self, resource):
-        resource.clone(self.working_dir)
+        if not resource.commit:
+            self.clone_resource(resource)
         self.generation_info[resource.repo_name] = {'tag': resource.tag, 'commit': resource.commit}
         logo_path = os.path.join(self.images_dir, resource.logo_file)
         if not os.path.isfile(logo_path):
-            command = f'cd "{self.images_dir}" && curl -O "{resource.logo_url}"'
-            subprocess.call(command, shell=True)
+            self.image_fetcher.fetch(resource.logo_url, logo_path)
 
     def setup_resources(self):
+        # The resources are all cloned at once, then set up in order
+        with ThreadPoolExecutor(max_workers=max(1, min(len(self.resources), MAX_CLONE_WORKERS))) as executor:
+            for future in [executor.submit(self.clone_resource, resource) for resource in self.resources.values()]:
+                future.result()
         for resource_name, resource in self.resources.items():
             self.setup_resource(resource)
 
@@ -478,20 +518,24 @@ class PdfConverter:
             return {}
 
     def download_all_images(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        self.download_soup_images(soup)
+        return str(soup)
+
+    def download_soup_images(self, soup):
         img_dir = os.path.join(self.images_dir, f'{self.main_resource.repo_name}_images')
         os.makedirs(img_dir, exist_ok=True)
-        soup = BeautifulSoup(html, 'html.parser')
+        downloads = OrderedDict()
         for img in soup.find_all('img'):
             if img['src'].startswith('http'):
                 url = img['src']
                 filename = re.search(r'/([\w_-]+[.](jpg|gif|png))$', url).group(1)
                 img['src'] = f'images/{self.main_resource.repo_name}_images/{filename}'
                 filepath = os.path.join(img_dir, filename)
-                if not os.path.exists(filepath):
-                    with open(filepath, 'wb') as f:
-                        response = requests.get(url)
-                        f.write(response.content)
-        return str(soup)
+                if not os.path.exists(filepath) and filepath not in downloads:
+                    downloads[filepath] = url
+        self.logger.info(f'Fetching {len(downloads)} images...')
+        self.image_fetcher.fetch_all([(url, filepath) for filepath, url in downloads.items()])
 
     @abstractmethod
     def get_body_html(self):
@@ -503,12 +547,17 @@ class PdfConverter:
                 return rc
 
     def get_toc_html(self, body_html):
+        soup = BeautifulSoup(body_html, 'html.parser')
+        toc_html = self.get_soup_toc_html(soup)
+        return [str(soup), toc_html]
+
+    def get_soup_toc_html(self, soup):
+        # Also puts the hidden heading-right span before each header of the body soup
         toc_html = f'''
 <article id="contents">
     {self.toc_title}
 '''
         prev_toc_level = 0
-        soup = BeautifulSoup(body_html, 'html.parser')
         done = {}
         heading_titles = [None, None, None, None, None, None]
         for header in soup.find_all(re.compile(r'^h\d'), {'class': 'section-header'}):
@@ -552,7 +601,7 @@ class PdfConverter:
         for level in range(prev_toc_level, 0, -1):
             toc_html += '</li>\n</ul>\n'
         toc_html += '</article>'
-        return [str(soup), toc_html]
+        return toc_html
 
     def get_cover_html(self):
         if self.project_id:
@@ -637,21 +686,38 @@ class PdfConverter:
             phrases.append(header.text)
         return phrases
 
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def get_highlight_regex(part, in_spans):
+        escaped_part = re.escape(part)
+        if in_spans:
+            split_pattern = '(' + re.sub('(\\\\ +)', r'(\\s+|(\\s*</*span[^>]*>\\s*)+)', escaped_part) + ')'
+        else:
+            split_pattern = '(' + escaped_part + ')'
+        split_pattern += '(?![^<]*>)'  # don't match within HTML tags
+        return re.compile(split_pattern)
+
+    @staticmethod
+    def could_highlight(text, part, in_spans):
+        # Quick check before trying the regex: the part can only match if the text has it as is,
+        # or, if it can match across spans, has each of its words as is
+        if in_spans:
+            return all(word in text for word in part.split(' '))
+        return part in text
+
     @staticmethod
     def highlight_text(text, phrase):
         parts = re.split(r'\s*…\s*|\s*\.\.\.\s*', phrase)
         processed_text = ''
         to_process_text = text
+        in_spans = '<span' in text
         for idx, part in enumerate(parts):
             if not part.strip():
                 continue
-            escaped_part = re.escape(part)
-            if '<span' in text:
-                split_pattern = '(' + re.sub('(\\\\ +)', r'(\\s+|(\\s*</*span[^>]*>\\s*)+)', escaped_part) + ')'
+            if PdfConverter.could_highlight(to_process_text, part, in_spans):
+                splits = PdfConverter.get_highlight_regex(part, in_spans).split(to_process_text, 1)
             else:
-                split_pattern = '(' + escaped_part + ')'
-            split_pattern += '(?![^<]*>)'  # don't match within HTML tags
-            splits = re.split(split_pattern, to_process_text, 1)
+                splits = [to_process_text]
             processed_text += splits[0]
             if len(splits) > 1:
                 highlight_classes = "highlight"
@@ -695,7 +761,11 @@ class PdfConverter:
                     phrase.replace('’', "'"),
                     # All right pointing curly single quotes made straight
                     phrase.replace('‘', "'")]
+                tried = set()
                 for alt_phrase in alt_phrase:
+                    if alt_phrase in tried:
+                        continue
+                    tried.add(alt_phrase)
                     if orig_text != self.highlight_text(orig_text, alt_phrase):
                         bad_highlights[phrase] = alt_phrase
                         break
@@ -721,6 +791,15 @@ class PdfConverter:
             header['class'] = header.get('class', []) + ['section-header']
         return str(soup)
 
+    def make_soup_first_headers_section_headers(self, soup):
+        # Same as make_first_header_section_header() on each article in section_header_article_ids,
+        # but in one pass over the body soup
+        for article in soup.find_all('article', id=True):
+            if article['id'] in self.section_header_article_ids:
+                header = article.find(re.compile(r'^h\d'))
+                if header:
+                    header['class'] = header.get('class', []) + ['section-header']
+
     @staticmethod
     def decrease_headers(html, minimum_header=2, decrease=1):
         if html:
@@ -785,29 +864,43 @@ class PdfConverter:
         # Case 5
         return title if title else rc_link
 
+    def add_rc_link_rules(self, link_rewriter):
+        link_rewriter.add_rule(r'(\[\[|<a[^>]+href=")*(rc://[/A-Za-z0-9*_-]+)(\]\]|"[^>]*>(.*?)</a>)*', self.replace_rc,
+                               'rc://')
+
     def replace_rc_links(self, text):
-        regex = re.compile(r'(\[\[|<a[^>]+href=")*(rc://[/A-Za-z0-9*_-]+)(\]\]|"[^>]*>(.*?)</a>)*')
-        text = regex.sub(self.replace_rc, text)
-        return text
+        link_rewriter = LinkRewriter()
+        self.add_rc_link_rules(link_rewriter)
+        return link_rewriter.rewrite(text)
 
     @staticmethod
-    def _fix_links(html):
+    def add_url_link_rules(link_rewriter):
         # Change [[http.*]] to <a href="http\1">http\1</a>
-        html = re.sub(r'\[\[http([^\]]+)\]\]', r'<a href="http\1">http\1</a>', html, flags=re.IGNORECASE)
+        link_rewriter.add_rule(r'\[\[http([^\]]+)\]\]', r'<a href="http\1">http\1</a>', r'\[\[[hH]',
+                               flags=re.IGNORECASE)
 
         # convert URLs to links if not already
-        html = re.sub(r'([^">])((http|https|ftp)://[A-Za-z0-9/?&_.:=#-]+[A-Za-z0-9/?&_:=#-])',
-                      r'\1<a href="\2">\2</a>', html, flags=re.IGNORECASE)
+        link_rewriter.add_rule(r'([^">])((http|https|ftp)://[A-Za-z0-9/?&_.:=#-]+[A-Za-z0-9/?&_:=#-])',
+                               r'\1<a href="\2">\2</a>', r'[pPsS]://', flags=re.IGNORECASE)
 
         # URLS wth just www at the start, no http
-        html = re.sub(r'([^/])(www\.[A-Za-z0-9/?&_.:=#-]+[A-Za-z0-9/?&_:=#-])', r'\1<a href="http://\2">\2</a>',
-                      html, flags=re.IGNORECASE)
+        link_rewriter.add_rule(r'([^/])(www\.[A-Za-z0-9/?&_.:=#-]+[A-Za-z0-9/?&_:=#-])', r'\1<a href="http://\2">\2</a>',
+                               r'[wW]\.', flags=re.IGNORECASE)
 
-        return html
+    @staticmethod
+    def _fix_links(html):
+        link_rewriter = LinkRewriter()
+        PdfConverter.add_url_link_rules(link_rewriter)
+        return link_rewriter.rewrite(html)
+
+    def add_link_rules(self, link_rewriter):
+        # can be implemented by child class to add its own link fixes, which are done before the others
+        pass
 
     def fix_links(self, html):
-        # can be implemented by child class
-        return html
+        link_rewriter = LinkRewriter()
+        self.add_link_rules(link_rewriter)
+        return link_rewriter.rewrite(html)
 
     def get_appendix_rcs(self):
         for rc_link, rc in self.rcs.items():
@@ -1017,7 +1110,8 @@ class PdfConverter:
             if fix:
                 self.add_bad_link(source_rc, rc.rc_link, fix)
             tw_article_html = markdown2.markdown_path(file_path)
-            tw_article_html = self.make_first_header_section_header(tw_article_html)
+            # The first header is made a section header by make_soup_first_headers_section_headers()
+            self.section_header_article_ids.add(rc.article_id)
             tw_article_html = self.increase_headers(tw_article_html)
             tw_article_html = self.fix_tw_links(tw_article_html, rc.extra_info[0])
             tw_article_html = f'''                
@@ -13,6 +13,8 @@ Class for a resource
 """
 import os
 import git
+import fcntl
+from urllib.parse import urlparse
 from collections import OrderedDict
 from ..general_tools.file_utils import load_yaml_object
 
@@ -63,26 +65,81 @@ class Resource(object):
     def get_resource_git_url(resource, owner):
         return f'https://git.door43.org/{owner}/{resource}.git'
 
-    def clone(self, working_dir):
+    @staticmethod
+    def get_remote_refs(url, *patterns):
+        """
+        Checks a remote repo without cloning any of it (with git ls-remote)
+        :return: dict of ref -> commit for the refs that match the patterns, or None if there's no such repo
+        """
+        try:
+            output = git.Git().ls_remote(url, *patterns, env={'GIT_TERMINAL_PROMPT': '0'})
+        except git.GitCommandError:
+            return None
+        return {ref: commit for commit, ref in (line.split('\t') for line in output.splitlines())}
+
+    def find_url(self):
+        """
+        :return: the URL of the repo or, if there's no repo there, the URL for the first of OWNERS that has it
+        """
+        if self.get_remote_refs(self.url, 'HEAD') is not None:
+            return self.url
+        for owner in OWNERS:
+            url = self.get_resource_git_url(self.repo_name, owner)
+            if self.get_remote_refs(url, 'HEAD') is not None:
+                return url
+        return self.url
+
+    def get_cache_repo_dir(self, cache_dir):
+        parsed_url = urlparse(self.url)
+        return os.path.join(cache_dir, parsed_url.netloc, parsed_url.path.strip('/'))
+
+    def update_cache(self, cache_dir):
+        """
+        Brings the bare mirror of the repo in the cache up to date, making it if it isn't there yet,
+        so that every clone of the repo can get its objects from there (with --reference) instead of the network.
+        The clones copy the objects they need (with --dissociate), so pruning the mirror can't break them.
+        A lock file stops two runs updating the same mirror at once.
+        :return: the mirror's dir
+        """
+        cache_repo_dir = self.get_cache_repo_dir(cache_dir)
+        os.makedirs(os.path.dirname(cache_repo_dir), exist_ok=True)
+        with open(f'{cache_repo_dir}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isdir(cache_repo_dir):
+                git.Git(cache_repo_dir).fetch('--prune', 'origin')
+            else:
+                git.Repo.clone_from(self.url, cache_repo_dir, mirror=True)
+        return cache_repo_dir
+
+    def clone(self, working_dir, cache_dir=None):
+        """
+        Clones the repo into working_dir if it isn't there yet (otherwise updates it), and checks out the tag
+        :param cache_dir: dir of the shared mirrors of the repos to clone from.
+                            Without one, the clone is shallow (just the tag).
+        """
         if not self.url:
             self.url = self.get_resource_git_url(self.repo_name, self.owner)
         self.repo_dir = os.path.join(working_dir, self.repo_name)
         if not os.path.isdir(self.repo_dir):
-            try:
-                git.Repo.clone_from(self.url, self.repo_dir)
-            except git.GitCommandError:
-                owners = OWNERS
-                for owner in owners:
-                    self.url = self.get_resource_git_url(self.repo_name, owner)
-                    try:
-                        git.Repo.clone_from(self.url, self.repo_dir)
-                    except git.GitCommandError:
-                        continue
-                    if os.path.isdir(self.repo_dir):
-                        break
+            self.url = self.find_url()
+            if cache_dir and not RUN_LOCALLY:
+                git.Repo.clone_from(self.url, self.repo_dir, reference=self.update_cache(cache_dir),
+                                    dissociate=True)
+            else:
+                try:
+                    git.Repo.clone_from(self.url, self.repo_dir, branch=self.tag, depth=1)
+                except git.GitCommandError:
+                    # Not a branch or tag, e.g. a commit, so it needs the history
+                    git.Repo.clone_from(self.url, self.repo_dir)
         self.git = git.Git(self.repo_dir)
         if not RUN_LOCALLY:
             self.git.fetch()
+            if os.path.isfile(os.path.join(self.repo_dir, '.git', 'shallow')) and self.tag != DEFAULT_TAG:
+                try:
+                    # A shallow clone only fetches its own branch, so this gets the tag if it's a new one
+                    self.git.fetch('--depth=1', 'origin', f'+refs/tags/{self.tag}:refs/tags/{self.tag}')
+                except git.GitCommandError:
+                    pass
         self.git.checkout(self.tag)
         if self.tag == DEFAULT_TAG and not RUN_LOCALLY:
             self.git.pull()
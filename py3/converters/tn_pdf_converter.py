@@ -15,6 +15,8 @@ import re
 from datetime import datetime
 from ..general_tools.file_utils import write_file, read_file, load_json_object, unzip, load_yaml_object
 from ..general_tools.usfm_utils import usfm3_to_usfm2
+from ..usfm_tools.verseIndex import scanVerses, chapterVerse
+from ..usfm_tools.versification import getVersification
 from .pdf_converter import PdfConverter, run_converter
 
 
@@ -116,18 +118,14 @@ class TnPdfConverter(PdfConverter):
         book_file = os.path.join(self.resources['ust'].repo_dir, f'{self.book_number}-{self.book_id.upper}.usfm')
         usfm3 = read_file(book_file)
         usfm2 = usfm3_to_usfm2(usfm3)
-        chapters = usfm2.split(r'\c ')
-        for chapter_usfm in chapters[1:]:
-            chapter = int(re.findall('(\d+)', chapter_usfm)[0])
-            book_data[chapter] = {}
-            chapter_usfm = r'\c '+chapter_usfm
-            verses = chapter_usfm.split(r'\v ')
-            for verseUsfm in verses[1:]:
-                verse = int(re.findall('(\d+)', verseUsfm)[0])
-                verseUsfm = r'\v '+verseUsfm
-                if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
-                    verseUsfm = ''
-                book_data[chapter][verse] = verseUsfm
+        for chapter, verse, start, end in scanVerses(usfm2):
+            if verse == chapterVerse:
+                book_data[chapter] = {}
+                continue
+            verseUsfm = usfm2[start:end]
+            if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
+                verseUsfm = ''
+            book_data[chapter][verse] = verseUsfm
         self.verse_usfm[self.ust_id] = book_data
 
     def populate_verse_usfm_ult(self):
@@ -135,18 +133,14 @@ class TnPdfConverter(PdfConverter):
         book_file = os.path.join(self.ult_dir, '{0}-{1}.usfm'.format(self.book_number, self.book_id.upper()))
         usfm3 = read_file(book_file)
         usfm2 = usfm3_to_usfm2(usfm3)
-        chapters = usfm2.split(r'\c ')
-        for chapterUsfm in chapters[1:]:
-            chapter = int(re.findall('(\d+)', chapterUsfm)[0])
-            bookData[chapter] = {}
-            chapterUsfm = r'\c '+chapterUsfm
-            verses = chapterUsfm.split(r'\v ')
-            for verseUsfm in verses[1:]:
-                verse = int(re.findall('(\d+)', verseUsfm)[0])
-                verseUsfm = r'\v '+verseUsfm
-                if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
-                    verseUsfm = ''
-                bookData[chapter][verse] = verseUsfm
+        for chapter, verse, start, end in scanVerses(usfm2):
+            if verse == chapterVerse:
+                bookData[chapter] = {}
+                continue
+            verseUsfm = usfm2[start:end]
+            if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
+                verseUsfm = ''
+            bookData[chapter][verse] = verseUsfm
         self.verse_usfm[self.ult_id] = bookData
 
     def populate_chapters_and_verses(self):
@@ -254,7 +248,7 @@ class TnPdfConverter(PdfConverter):
                 if idx < len(chapter_verses['first_verses'])-1:
                     last_verse = chapter_verses['first_verses'][idx+1] - 1
                 else:
-                    last_verse = int(BOOK_CHAPTER_VERSES[self.book_id][chapter])
+                    last_verse = getVersification().nVerses(self.book_id.upper(), int(chapter))
 
                 chunk_notes = ''
                 for verse in range(first_verse, last_verse + 1):
@@ -25,10 +25,11 @@ def usfm3_to_usfm2(usfm):
     
     # Pair up quotes by chapter
     chapters = re.compile(r'\\c').split(usfm)
-    usfm = chapters[0]
+    paired = [chapters[0]]
     for chapter in chapters[1:]:
         chapter = re.sub(r'\s*"\s*([^"]+)\s*"\s*', r' "\1" ', chapter, flags=re.UNICODE | re.MULTILINE | re.DOTALL)
-        usfm += '\c'+chapter
+        paired.append('\\c'+chapter)
+    usfm = ''.join(paired)
     usfm = re.sub(r'\\(\w+\**)([^\w* \n])', r'\\\1 \2', usfm, flags=re.UNICODE | re.MULTILINE) # \\q1" => \q1 "
     usfm = re.sub(r" ' ", r" '", usfm, flags=re.UNICODE | re.MULTILINE)
     usfm = re.sub(r' +([:;.?,!\]})-])', r'\1', usfm, flags=re.UNICODE | re.MULTILINE)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Differential test of the parseUsfm engines
+#   Every engine must give the same tokens for every fixture -- and for every line of each fixture on its own.
+#   Run from the top of the repo with: python3 -m pytest py3/tests
+#
+
+import os
+import glob
+import unittest
+from unittest import mock
+
+from py3.usfm_tools import parseUsfm
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FIXTURE_PATHS = sorted(glob.glob(os.path.join(FIXTURES_DIR, 'parse_usfm', '*.usfm'))) + \
+                [os.path.join(FIXTURES_DIR, '65-3JN-aligned.usfm')]
+
+
+def read_fixture(path):
+    with open(path, 'rt', encoding='utf-8', newline='') as fixture_file:
+        return fixture_file.read()
+
+
+def compare_engines(usfm):
+    """
+    Same as parseUsfm.compareEngines() but a string that no engine can parse counts as identical
+    :return: None if the engines agree, else a message about the first difference
+    """
+    try:
+        return parseUsfm.compareEngines(usfm)
+    except Exception:
+        pass
+    for engine in parseUsfm.engines:
+        try:
+            parseUsfm.parseString(usfm, engine)
+            return f"{engine} parsed {usfm!r} but another engine raised an exception"
+        except Exception:
+            pass
+    return None
+
+
+class TestCompareEngines(unittest.TestCase):
+
+    def setUp(self):
+        # The cache would hand back the 'fast' tokens without scanning
+        patcher = mock.patch.object(parseUsfm, 'parseCache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fixtures(self):
+        self.assertTrue(FIXTURE_PATHS)
+        for path in FIXTURE_PATHS:
+            with self.subTest(fixture=os.path.basename(path)):
+                usfm = read_fixture(path)
+                self.assertTrue(parseUsfm.parseString(usfm))
+                self.assertIsNone(parseUsfm.compareEngines(usfm))
+
+    def test_fixture_lines(self):
+        for path in FIXTURE_PATHS:
+            for n, line in enumerate(read_fixture(path).splitlines(keepends=True), start=1):
+                with self.subTest(fixture=os.path.basename(path), line=n):
+                    self.assertIsNone(compare_engines(line))
+
+    def test_difference_is_reported(self):
+        usfm = read_fixture(FIXTURE_PATHS[0])
+        with mock.patch.object(parseUsfm, 'scanString', lambda s: parseUsfm.usfm.parseString(s)[:-1]):
+            self.assertIsNotNone(parseUsfm.compareEngines(usfm))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+#
+# Golden test of usfm3_to_usfm2()
+#   Run from the top of the repo with: python3 -m pytest py3/tests
+#
+
+import os
+import unittest
+
+from py3.general_tools.usfm_utils import usfm3_to_usfm2
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rt', encoding='utf-8', newline='') as fixture_file:
+        return fixture_file.read()
+
+
+class TestUsfm3ToUsfm2(unittest.TestCase):
+
+    def test_aligned_book(self):
+        # 65-3JN-usfm2.usfm is the output of the original usfm3_to_usfm2() for the aligned book
+        usfm = read_fixture('65-3JN-aligned.usfm')
+        self.assertEqual(usfm3_to_usfm2(usfm), read_fixture('65-3JN-usfm2.usfm'))
+
+    def test_no_chapters(self):
+        self.assertEqual(usfm3_to_usfm2('\\id 3JN\n\\h 3 John\n'), '\\id 3JN\n\\h 3 John')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,10 +31,12 @@ from glob import glob
 from bs4 import BeautifulSoup
 from weasyprint import HTML, LOGGER
 from datetime import datetime
-from ..usfm_tools.transform import UsfmTransform
+from ..usfm_tools.singlehtmlRenderer import SingleHTMLRenderer
+from ..usfm_tools.verseIndex import scanVerses, chapterVerse
+from ..usfm_tools.versification import getVersification
 from ..general_tools.file_utils import write_file, read_file, load_json_object, unzip, load_yaml_object
 from ..general_tools.url_utils import download_file
-from ..general_tools.bible_books import BOOK_NUMBERS, BOOK_CHAPTER_VERSES
+from ..general_tools.bible_books import BOOK_NUMBERS
 from ..general_tools.usfm_utils import usfm3_to_usfm2
 
 
@@ -156,6 +158,8 @@ class TnConverter(object):
         self.soup = None
         self.date = datetime.now().strftime('%Y-%m-%d')
         self.verse_to_chunk = {}
+        # Render the ULT/UST chunks a whole book at a time (rather than each chunk by itself)
+        self.render_whole_books = True
 
     def run(self):
         self.setup_resource_files()
@@ -409,7 +413,7 @@ class TnConverter(object):
                 if len(chapter_data['first_verses']) > idx+1:
                     last_verse = chapter_data['first_verses'][idx+1] - 1
                 else:
-                    last_verse = int(BOOK_CHAPTER_VERSES[self.book_id][str(chapter)])
+                    last_verse = getVersification().nVerses(self.book_id.upper(), int(chapter))
                 chunks_text[str(chapter)][str(first_verse)] = {
                     'first_verse': first_verse,
                     'last_verse': last_verse
@@ -436,8 +440,16 @@ class TnConverter(object):
                         chunks_text[str(chapter)][str(first_verse)][resource] = {}
                     chunks_text[str(chapter)][str(first_verse)][resource] = {
                         'usfm': chunk_usfm,
-                        'html': self.get_chunk_html(chunk_usfm, resource, chapter, first_verse)
+                        'html': None if self.render_whole_books else
+                                self.get_chunk_html(chunk_usfm, resource, chapter, first_verse)
                     }
+            if not self.render_whole_books:
+                if not os.path.exists(save_dir):
+                    os.makedirs(save_dir)
+                write_file(save_file, chunks_text)
+        if self.render_whole_books:
+            for resource in [self.ult_id, self.ust_id]:
+                self.populate_book_chunks_html(chunks_text, resource)
             if not os.path.exists(save_dir):
                 os.makedirs(save_dir)
             write_file(save_file, chunks_text)
@@ -652,18 +664,14 @@ class TnConverter(object):
         book_file = os.path.join(self.ust_dir, '{0}-{1}.usfm'.format(self.book_number, self.book_id.upper()))
         usfm3 = read_file(book_file)
         usfm2 = usfm3_to_usfm2(usfm3)
-        chapters = usfm2.split(r'\c ')
-        for chapter_usfm in chapters[1:]:
-            chapter = int(re.findall('(\d+)', chapter_usfm)[0])
-            book_data[chapter] = {}
-            chapter_usfm = r'\c '+chapter_usfm
-            verses = chapter_usfm.split(r'\v ')
-            for verseUsfm in verses[1:]:
-                verse = int(re.findall('(\d+)', verseUsfm)[0])
-                verseUsfm = r'\v '+verseUsfm
-                if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
-                    verseUsfm = ''
-                book_data[chapter][verse] = verseUsfm
+        for chapter, verse, start, end in scanVerses(usfm2):
+            if verse == chapterVerse:
+                book_data[chapter] = {}
+                continue
+            verseUsfm = usfm2[start:end]
+            if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
+                verseUsfm = ''
+            book_data[chapter][verse] = verseUsfm
         self.verse_usfm[self.ust_id] = book_data
 
     def populate_verse_usfm_ult(self):
@@ -671,18 +679,14 @@ class TnConverter(object):
         book_file = os.path.join(self.ult_dir, '{0}-{1}.usfm'.format(self.book_number, self.book_id.upper()))
         usfm3 = read_file(book_file)
         usfm2 = usfm3_to_usfm2(usfm3)
-        chapters = usfm2.split(r'\c ')
-        for chapterUsfm in chapters[1:]:
-            chapter = int(re.findall('(\d+)', chapterUsfm)[0])
-            bookData[chapter] = {}
-            chapterUsfm = r'\c '+chapterUsfm
-            verses = chapterUsfm.split(r'\v ')
-            for verseUsfm in verses[1:]:
-                verse = int(re.findall('(\d+)', verseUsfm)[0])
-                verseUsfm = r'\v '+verseUsfm
-                if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
-                    verseUsfm = ''
-                bookData[chapter][verse] = verseUsfm
+        for chapter, verse, start, end in scanVerses(usfm2):
+            if verse == chapterVerse:
+                bookData[chapter] = {}
+                continue
+            verseUsfm = usfm2[start:end]
+            if re.match(r'^\\v \d+\s*$', verseUsfm, flags=re.MULTILINE):
+                verseUsfm = ''
+            bookData[chapter][verse] = verseUsfm
         self.verse_usfm[self.ult_id] = bookData
 
     def populate_chapters_and_verses(self):
@@ -790,7 +794,7 @@ class TnConverter(object):
                 if idx < len(chapter_verses['first_verses'])-1:
                     last_verse = chapter_verses['first_verses'][idx+1] - 1
                 else:
-                    last_verse = int(BOOK_CHAPTER_VERSES[self.book_id][chapter])
+                    last_verse = getVersification().nVerses(self.book_id.upper(), int(chapter))
 
                 chunk_notes = ''
                 for verse in range(first_verse, last_verse + 1):
@@ -1461,36 +1465,52 @@ class TnConverter(object):
         text = re.sub(r' 0*(\d+):0*(\d+)(-*)0*(\d*)', r' \1:\2\3\4', text, flags=re.IGNORECASE | re.MULTILINE)
         return text
 
-    def get_chunk_html(self, usfm, resource, chapter, verse):
-        usfm_chunks_path = os.path.join(self.working_dir, 'usfm_chunks', 'usfm-{0}-{1}-{2}-{3}-{4}'.
-                                        format(self.lang_code, resource, self.book_id, chapter, verse))
-        filename_base = '{0}-{1}-{2}-{3}'.format(resource, self.book_id, chapter, verse)
-        html_file = os.path.join(usfm_chunks_path, '{0}.html'.format(filename_base))
-        usfm_file = os.path.join(usfm_chunks_path, '{0}.usfm'.format(filename_base))
-        if not os.path.exists(usfm_chunks_path):
-            os.makedirs(usfm_chunks_path)
-        usfm = '''\id {0}
+    def get_chunk_usfm_header(self):
+        return '''\id {0}
 \ide UTF-8
 \h {1}
 \mt {1}
 
-\c {2}
-{3}'''.format(self.book_id.upper(), self.book_title, chapter, usfm)
-        write_file(usfm_file, usfm)
-        UsfmTransform.buildSingleHtml(usfm_chunks_path, usfm_chunks_path, filename_base)
-        html = read_file(os.path.join(usfm_chunks_path, filename_base+'.html'))
+'''.format(self.book_id.upper(), self.book_title)
+
+    def get_chunk_html(self, usfm, resource, chapter, verse):
+        usfm = self.get_chunk_usfm_header() + '\\c {0}\n{1}'.format(chapter, usfm)
+        html = SingleHTMLRenderer().renderString(usfm)
         soup = BeautifulSoup(html, 'html.parser')
-        header = soup.find('h1')
+        return self.get_chunk_body_html(soup.body, resource)
+
+    def populate_book_chunks_html(self, chunks_text, resource):
+        """
+        Renders all the chunks of the resource for this book in one go, and parses them with one BeautifulSoup
+            (giving the same HTML as calling get_chunk_html() for each chunk)
+        """
+        chunks = []
+        usfm = self.get_chunk_usfm_header()
+        for chapter in chunks_text:
+            for first_verse in chunks_text[chapter]:
+                chunk = chunks_text[chapter][first_verse][resource]
+                chunks.append(chunk)
+                usfm += '\\c {0}\n{1}\n'.format(chapter, chunk['usfm'])
+        htmls = SingleHTMLRenderer().renderChunks(usfm, includeHeader=True, includeChapterHeadings=True)
+        # Each chunk's body goes in an element of its own, whose end tag closes anything left open in the chunk
+        #   just as </body> did when each chunk was parsed by itself
+        bodies = ['<chunk>{0}</chunk>'.format(html[html.index('<body>') + len('<body>'):html.rindex('</body>')])
+                  for html in htmls]
+        soup = BeautifulSoup(''.join(bodies), 'html.parser')
+        for chunk, body in zip(chunks, soup.find_all('chunk', recursive=False)):
+            chunk['html'] = self.get_chunk_body_html(body, resource)
+
+    @staticmethod
+    def get_chunk_body_html(body, resource):
+        header = body.find('h1')
         if header:
             header.decompose()
-        chapter = soup.find('h2')
+        chapter = body.find('h2')
         if chapter:
             chapter.decompose()
-        for span in soup.find_all('span', {'class': 'v-num'}):
+        for span in body.find_all('span', {'class': 'v-num'}):
             span['id'] = '{0}-{1}'.format(resource, span['id'])
-        html = ''.join(['%s' % x for x in soup.body.contents])
-        write_file(html_file, html)
-        return html
+        return ''.join(['%s' % x for x in body.contents])
 
 
 def main(ta_tag, tn_tag, tw_tag, ust_tag, ult_tag, ust_id, ult_id, tn_id,
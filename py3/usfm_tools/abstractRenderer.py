@@ -1,16 +1,51 @@
+import io
+import copy
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
-from .books import loadBooks, silNames
+from .books import loadBooks, readBook, silNames
 from .parseUsfm import parseString
 
 
 
+def renderBookInWorker(rendererClass, state, usfm, usfmPath, finish):
+    """
+    Renders one book in a worker process for AbstractRenderer.runParallel()
+    :param state: renderer state (from getBookState()) to start from
+    :param usfm: the book, or None to read it from usfmPath
+    :param finish: True if more books follow this one
+    :return: the rendered output, the renderer state at the end, and the unknowns and warnings lists
+    """
+    if usfm is None:
+        usfm = readBook(usfmPath)
+    renderer = rendererClass.__new__(rendererClass)
+    renderer.__dict__.update(state)
+    renderer.f = io.StringIO()
+    renderer.unknowns = []
+    warning_list = []
+    renderer.renderUSFM(usfm, warning_list)
+    if finish:
+        renderer.finishBook()
+    return renderer.f.getvalue(), renderer.getBookState(), renderer.unknowns, warning_list
+
+
+
 class AbstractRenderer:
 
     booksUsfm = None
 
     chapterLabel = 'Chapter'
 
+    # For rendering several books at once in worker processes (see runParallel())
+    #   where derived renderers write their output to self.f
+    parallel = False
+    workers = None # None means one for each CPU
+    # Instance attributes that aren't rendering state, i.e., input, output, and settings
+    nonStateAttributes = ('f', 'booksUsfm', 'unknowns', 'parallel', 'workers')
+    # Instance attributes that every book sets before using them
+    #   (so they don't carry over from one book to the next)
+    bookResetAttributes = ()
+
     def writeLog(self, s):
         # logging.info(s)
         pass
@@ -30,24 +65,19 @@ class AbstractRenderer:
             bookName = self.renderBook # This gives an AttributeError for USFM
             if bookName in self.booksUsfm:
                 self.writeLog('     (' + bookName + ')')
-                tokens = parseString(self.booksUsfm[bookName])
-                for t in tokens:
-                    try:
-                        t.renderOn(self)
-                    except Exception as e:
-                        warning_list.append(f"Unable to render '{t.type}' token due to {e}")
+                self.renderUSFM(self.booksUsfm[bookName], warning_list)
+                self.releaseBook(bookName)
         except AttributeError:
             # logging.debug("AbstractRenderer.run() now using silNames…")
-            for bookName in silNames:
-                if bookName in self.booksUsfm:
+            bookNames = [bookName for bookName in silNames if bookName in self.booksUsfm]
+            if self.parallel and len(bookNames) > 1:
+                self.runParallel(bookNames, warning_list)
+            else:
+                for bookName in bookNames:
                     # logging.debug(f"AbstractRenderer.run() converting {bookName}…")
                     self.writeLog('     (' + bookName + ')')
-                    tokens = parseString(self.booksUsfm[bookName])
-                    for t in tokens:
-                        try:
-                            t.renderOn(self)
-                        except Exception as e:
-                            warning_list.append(f"Unable to render '{t.type}' token due to {e}")
+                    self.renderUSFM(self.booksUsfm[bookName], warning_list)
+                    self.releaseBook(bookName)
         if self.unknowns:
             unknownsSet = set(self.unknowns)
             msg = f"Renderer skipped {len(self.unknowns)} total, {len(unknownsSet)} unique unknown USFM tokens: {', '.join(unknownsSet)}"
@@ -57,6 +87,105 @@ class AbstractRenderer:
     # end of run()
 
 
+    def renderUSFM(self, usfm, warning_list):
+        self.renderTokens(parseString(usfm), warning_list)
+
+
+    def renderTokens(self, tokens, warning_list):
+        for t in tokens:
+            try:
+                t.renderOn(self)
+            except Exception as e:
+                warning_list.append(f"Unable to render '{t.type}' token due to {e}")
+
+
+    def runParallel(self, bookNames, warning_list):
+        """
+        Renders each book in a worker process into its own buffer
+            then writes them all out in the given order.
+
+        Each worker starts from a prediction (see predictBookState()) of the state
+            after the books before it, e.g., footnote and cross-reference numbers.
+        Any book where that turns out to be wrong is rendered again here from the actual state
+            so the output is always the same as rendering the books one after another,
+            and the books after it are predicted again from there.
+        """
+        startStates, futures = {}, {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            self.submitBooks(executor, bookNames, 0, self.getBookState(), startStates, futures)
+            for n, bookName in enumerate(bookNames):
+                self.writeLog('     (' + bookName + ')')
+                output, endState, unknowns, book_warning_list = futures.pop(n).result()
+                if self.sameBookState(startStates[n], self.getBookState()):
+                    self.f.write(output)
+                    self.__dict__.update(endState)
+                    self.unknowns.extend(unknowns)
+                    warning_list.extend(book_warning_list)
+                else:
+                    logging.info(f"AbstractRenderer.runParallel() is rendering {bookName} again as its start state was mispredicted")
+                    self.renderUSFM(self.booksUsfm[bookName], warning_list)
+                    if n < len(bookNames) - 1:
+                        self.finishBook()
+                        self.submitBooks(executor, bookNames, n + 1, self.getBookState(), startStates, futures)
+                self.releaseBook(bookName)
+
+
+    def submitBooks(self, executor, bookNames, first, state, startStates, futures):
+        """
+        Predicts the start state of each book from bookNames[first] on
+            and sets a worker rendering each one that isn't already being rendered from that state
+        :param state: the start state of bookNames[first]
+        """
+        for n in range(first, len(bookNames)):
+            if n > first:
+                state = self.predictBookState(copy.deepcopy(state), self.booksUsfm[bookNames[n - 1]])
+                self.releaseBook(bookNames[n - 1])
+            if n in futures:
+                if self.sameBookState(startStates[n], state):
+                    break # So the rest are already being rendered from the right states too
+                futures[n].cancel()
+            startStates[n] = state
+            # A worker reads its book from the file if there is one, so the books aren't all held here
+            usfmPath = getattr(self.booksUsfm, 'paths', {}).get(bookNames[n])
+            futures[n] = executor.submit(renderBookInWorker, type(self), state,
+                                         None if usfmPath else self.booksUsfm[bookNames[n]], usfmPath,
+                                         n < len(bookNames) - 1)
+
+
+    def releaseBook(self, bookName):
+        # Let go of the book's USFM if it came from loadBooks() -- it's not needed again
+        if hasattr(self.booksUsfm, 'release'):
+            self.booksUsfm.release(bookName)
+
+
+    def getBookState(self):
+        return {name: value for name, value in self.__dict__.items() if name not in self.nonStateAttributes}
+
+
+    def sameBookState(self, state1, state2):
+        return {name: value for name, value in state1.items() if name not in self.bookResetAttributes} \
+            == {name: value for name, value in state2.items() if name not in self.bookResetAttributes}
+
+
+    def predictBookState(self, state, usfm):
+        """
+        Derived renderers that carry state from one book to the next (e.g., footnote numbers)
+            should override this so that runParallel() can make use of the worker processes
+        :param state: the renderer state (from getBookState()) before the book (can be altered)
+        :param usfm: the book
+        :return: the (predicted) state after the book has been rendered and finishBook() called
+        """
+        return state
+
+
+    def finishBook(self):
+        """
+        Called by runParallel() after each book except the last
+            to write out anything the next book would otherwise write before its own output
+        """
+        pass
+
+
     # Added here May 2019 so they applied to all derived renderers
     # TODO: Should make this list extensive (from USFM 3 spec)
     # TODO: How do we remove the linter warnings
@@ -3,6 +3,7 @@
 
 import os
 import logging
+from collections.abc import Mapping
 
 __logger = logging.getLogger('usfm_tools')
 
@@ -363,34 +364,91 @@ def bookID(usfm):
 #     return bookNames[index]
 
 
+# noinspection PyPep8Naming
+def sniffBookID(full_file_name):
+    """
+    Reads just enough of the start of the file to find its book id
+    :return: the book id (e.g., 'GEN'), or None if it's not a USFM book
+    """
+    fname = os.path.basename(full_file_name)
+    # noinspection PyBroadException
+    try:
+        with open(full_file_name, 'rt') as f:
+            for line in f: # Skip any blank lines at the start
+                if line.strip():
+                    usfm = line.lstrip()
+                    if usfm[:4] == r'\id ' and usfm[4:7] in silNames:
+                        # print('     Found ' + fname + ' as ' + usfm[4:7])
+                        return bookID(usfm)
+                    break
+        __logger.info('Ignored ' + fname)
+    except:
+        __logger.warning(f"loadBooks couldn't open '{fname}'")
+    return None
+
+
+# noinspection PyPep8Naming
+def readBook(full_file_name):
+    """
+    :return: the USFM text of the book file
+    """
+    with open(full_file_name, 'rt') as f:
+        return f.read().lstrip()
+
+
+class BookCatalog(Mapping):
+    """
+    The USFM books in a folder as a read-only dict of USFM text keyed by book id (e.g., 'GEN')
+
+    Only the start of each file is read to find its book id.
+    The text of a book is read when it's first used,
+        and then kept until release() is called for it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = {}
+        self.texts = {}
+        for fname in os.listdir(path):
+            full_file_name = os.path.join(path, fname)
+            if not os.path.isfile(full_file_name):
+                continue
+            if fname[-4:].lower() in ['.pdf', '.sig']:
+                continue
+            book_id = sniffBookID(full_file_name)
+            if book_id:
+                self.paths[book_id] = full_file_name
+
+    def __getitem__(self, book_id):
+        if book_id not in self.texts:
+            self.texts[book_id] = readBook(self.paths[book_id])
+        return self.texts[book_id]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def release(self, book_id=None):
+        """
+        Frees the memory used by the text of the book (or all books if None)
+            -- it will be read again if it's used again
+        """
+        if book_id is None:
+            self.texts.clear()
+        else:
+            self.texts.pop(book_id, None)
+
+
 # noinspection PyPep8Naming
 def loadBooks(path):
-    loaded_books = {}
-    dirList = os.listdir(path)
-    __logger.debug(f"Loading all USFM book files from {path} …")
-    for fname in dirList:
-
-        full_file_name = os.path.join(path, fname)
-        if not os.path.isfile(full_file_name):
-            continue
-
-        if fname[-4:].lower() in ['.pdf', '.sig']:
-            continue
-
-        # noinspection PyBroadException
-        try:
-            f = open(full_file_name, 'rt')
-            usfm = f.read().lstrip()
-            if usfm[:4] == r'\id ' and usfm[4:7] in silNames:
-                # print('     Loaded ' + fname + ' as ' + usfm[4:7])
-                loaded_books[bookID(usfm)] = usfm
-                f.close()
-            else:
-                __logger.info('Ignored ' + fname)
-        except:
-            __logger.warning(f"loadBooks couldn't open '{fname}'")
-    # __logger.debug(f"Finished loading {len(loaded_books)} USFM book(s).")
-    return loaded_books
+    """
+    :return: a BookCatalog of the USFM books in the folder
+                (which only reads each book when it's first used)
+    """
+    __logger.debug(f"Finding USFM book files in {path} …")
+    return BookCatalog(path)
 
 
 # noinspection PyPep8Naming
@@ -0,0 +1,138 @@
+#
+# Optional on-disk cache of parsed USFM token streams
+#   so that unchanged books don't need parsing again
+#   (e.g., once for the linter, once for the HTML renderer, and again for each tN build).
+#
+# Each entry is a file holding the marshal'd list of token groups, i.e., (type,) or (type, value) tuples,
+#   named by a key that parseUsfm makes from the hash of the cleaned USFM and its grammar version.
+# The total size of the entries is capped, with the least recently used ones removed first.
+#
+
+import os
+import marshal
+import logging
+import tempfile
+from collections import OrderedDict
+
+
+cacheFileExtension = '.tokens'
+defaultMaxBytes = 256 * 1024 * 1024
+
+
+class ParseCache:
+
+    def __init__(self, directory, maxBytes=defaultMaxBytes):
+        """
+        :param directory: folder to keep the cache files in (created if necessary)
+        :param maxBytes: cap on the total size of the cache files
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = self.misses = self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # Sizes of the entries, least recently used first
+        self.entries = OrderedDict()
+        self.totalBytes = 0
+        existing = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(cacheFileExtension) and entry.is_file():
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name[:-len(cacheFileExtension)], stat.st_size))
+        for mtime, key, size in sorted(existing):
+            self.entries[key] = size
+            self.totalBytes += size
+        self.evict()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key + cacheFileExtension)
+
+
+    def get(self, key):
+        """
+        :return: the list of token groups for key, or None if it's not in the cache
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cacheFile:
+                groups = marshal.loads(cacheFile.read())
+            os.utime(path) # the file times are the LRU order for the next run
+        except FileNotFoundError: # maybe removed by another process
+            groups = None
+        except (EOFError, ValueError, TypeError) as e:
+            logging.warning(f"ParseCache: ignoring bad cache file {path}: {e}")
+            groups = None
+        if groups is None:
+            self.misses += 1
+            self.forget(key)
+            return None
+        self.hits += 1
+        if key not in self.entries:
+            self.entries[key] = os.path.getsize(path)
+            self.totalBytes += self.entries[key]
+        self.entries.move_to_end(key)
+        return groups
+
+
+    def put(self, key, groups):
+        """
+        Saves the token groups for key (written to a temporary file first
+            so that other processes sharing the cache never see part of an entry)
+        :param groups: list of (type,) or (type, value) tuples of str
+        """
+        data = marshal.dumps([tuple(group) for group in groups])
+        if len(data) > self.maxBytes:
+            return
+        fd, tempPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tempFile:
+                tempFile.write(data)
+            os.replace(tempPath, self.path(key))
+        except OSError as e:
+            logging.warning(f"ParseCache: unable to save {key}: {e}")
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            return
+        self.totalBytes -= self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        self.totalBytes += len(data)
+        self.evict()
+
+
+    def forget(self, key):
+        self.totalBytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+    def evict(self):
+        """
+        Removes the least recently used entries until we're back under the size cap
+        """
+        while self.totalBytes > self.maxBytes and self.entries:
+            self.forget(next(iter(self.entries)))
+            self.evictions += 1
+
+
+    def clear(self):
+        for key in list(self.entries):
+            self.forget(key)
+
+
+    def stats(self):
+        """
+        :return: dict of the counters (for logging to see if the cache is paying off)
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.totalBytes}
+
+
+    def __str__(self):
+        stats = self.stats()
+        return f"ParseCache({self.directory}): {stats['hits']} hits, {stats['misses']} misses, " \
+               f"{stats['evictions']} evictions, {stats['entries']} entries using {stats['bytes']:,} bytes"
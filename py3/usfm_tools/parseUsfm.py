@@ -2,11 +2,14 @@
 This version of parseUsfm.py appears to be used by verifyUSFM.py
     i.e., used by the USFM linter.
 """
+import os
 import sys
+import re
+import hashlib
 import logging
 
 from pyparsing import Word, OneOrMore, nums, Literal, White, Group, \
-        Suppress, NoMatch, Optional, CharsNotIn, MatchFirst
+        Suppress, NoMatch, Optional, CharsNotIn, MatchFirst, ParseException
 
 
 __logger = logging.getLogger('usfm_tools')
@@ -335,17 +338,251 @@ usfm    = OneOrMore(element)
 #         sys.exit()
 #     return [createToken(t) for t in tokens]
 
-def parseString(unicodeString):
+
+# Marker tables for the 'fast' engine below.
+# These MUST be kept in step with the pyparsing grammar above:
+#   every usfmTokenValue() key goes in valueMarkers (or plusMarkers if its value is 'plus'),
+#   every usfmToken() key in bareMarkers, every usfmEndToken() key in endMarkers,
+#   and every usfmTokenNumber() key in numberMarkers.
+valueMarkers = frozenset([
+    'id', 'ide', 'usfm', 'h',
+    'toc', 'toc1', 'toc2', 'toc3',
+    'mt', 'mt1', 'mt2', 'mt3',
+    'ms', 'ms1', 'ms2', 'mr',
+    'd', 's', 's1', 's2', 's3', 's4', 's5', 'sr', 'sts', 'r',
+    'cl',
+    'fr', 'fk', 'ft', 'fq', 'fqa', 'fqb', 'fv', 'fdc',
+    'xo', 'xt',
+    'sp', 'rem',
+    'is', 'is1',
+    'imt', 'imt1', 'imt2', 'imt3'])
+plusMarkers = frozenset(['f', 'fe', 'x'])
+bareMarkers = frozenset([
+    'p', 'pc', 'pi', 'pi1', 'pi2', 'mi', 'b', 'ca', 'va',
+    'q', 'q1', 'q2', 'q3', 'q4',
+    'qa', 'qac', 'qc', 'qm', 'qm1', 'qm2', 'qm3', 'qr', 'qs', 'qt',
+    'nb', 'm', 'fp', 'xdc', 'it', 'wj', 'nd', 'bd', 'bdit',
+    'li', 'li1', 'li2', 'li3', 'li4',
+    'add', 'tl',
+    'is2', 'is3', 'ip', 'im', 'imi', 'iot', 'io1', 'io', 'io2', 'ior', 'ie',
+    'bk', 'sc',
+    'tr', 'th1', 'th2', 'th3', 'th4', 'th5', 'th6',
+    'thr1', 'thr2', 'thr3', 'thr4', 'thr5', 'thr6',
+    'tc1', 'tc2', 'tc3', 'tc4', 'tc5', 'tc6',
+    'tcr1', 'tcr2', 'tcr3', 'tcr4', 'tcr5', 'tcr6'])
+endMarkers = frozenset([
+    'ca', 'va', 'qs', 'qt',
+    'fr', 'ft', 'fq', 'fqa', 'f', 'fe', 'fv', 'fdc',
+    'xdc', 'xt', 'x',
+    'it', 'wj', 'nd', 'bd', 'bdit', 'add', 'tl', 'ior', 'bk', 'sc'])
+numberMarkers = frozenset(['c', 'v'])
+
+# One step of the scanner: skip whitespace, then take either a run of text,
+#   an escaped backslash, or a backslash marker name and whatever follows it.
+# The whitespace set is the pyparsing default (which doesn't include \xa0 -- see clean()),
+#   and text may not start with whitespace (else the regex could back off the skip).
+# NOTE: pyparsing's White() quietly skips these other Unicode spaces before the real whitespace
+#   so '\q1' followed by a thin space and a newline is still a \q1 marker.
+otherWhite = '\f\xa0\u1680\u180e\u2000-\u200b\u202f\u205f\u3000'
+scan_re    = re.compile(r'[ \t\r\n]*(?:([^\\ \t\r\n][^\\\n]*)|(\\\\)|\\([^ \t\r\n\\*' + otherWhite + r']*)'
+                        r'(\*|[' + otherWhite + r']*[ \t\r\n]+|))')
+phrase_re  = re.compile(r'[^\n\\]*')
+number_re  = re.compile(r'([0-9()-]+)[' + otherWhite + r']*[ \t\r\n]')
+unknown_re = re.compile(r'[^ \n\t\\]+')
+trailing_re = re.compile(r'[ \t\r\n]*\Z')
+
+
+def scanGroups(cleaned, groups, final=True):
+    """
+    Single linear pass over cleaned (and tab-expanded) USFM text.
+
+    Appends exactly the same token groups (as tuples, e.g., ('v', '12'), ('text', 'In the beginning'),
+        ('unknown', 'zaln-s'), ('p',)) as the pyparsing grammar above would give,
+        but without trying every alternative at every position.
+    :param cleaned: USFM text that has already been through clean()
+    :param groups: list that the token groups are appended to
+    :param final: False if more text may follow, in which case scanning stops before any token
+                    that could still change with that text (e.g., '\\v 1' might become '\\v 12')
+    :return: the position in cleaned where scanning stopped
+    """
+    pos, end = 0, len(cleaned)
+    while pos < end:
+        start = pos
+        match = scan_re.match(cleaned, pos)
+        if match is None:
+            if trailing_re.match(cleaned, pos):
+                break # only whitespace left
+            raise ParseException(cleaned, pos, 'Expected end of text')
+        text, escaped, marker, after = match.groups()
+        pos = match.end()
+        group = None
+        if text is not None:
+            group = ('text', text)
+        elif escaped is not None:
+            group = ('\\\\',)
+        elif after == '*':
+            if marker in endMarkers:
+                group = (marker + '*',)
+        elif after:
+            if pos == end and not final:
+                return start # the whitespace (and so the marker's value) may carry on
+            if marker in valueMarkers:
+                value = phrase_re.match(cleaned, pos).group()
+                pos += len(value)
+                group = (marker, value) if value else (marker,)
+            elif marker in bareMarkers:
+                group = (marker,)
+            elif marker in plusMarkers:
+                if cleaned.startswith('+', pos):
+                    pos += 1
+                    group = (marker, '+')
+                else:
+                    group = (marker,)
+            elif marker in numberMarkers:
+                number = number_re.match(cleaned, pos)
+                if number:
+                    pos = number.end()
+                    group = (marker, number.group(1))
+        if group is None:
+            # Not a marker that we know -- back up and take it as unknown
+            unknown = unknown_re.match(cleaned, match.start(3))
+            if unknown is None:
+                raise ParseException(cleaned, match.start(3), 'Expected end of text')
+            pos = unknown.end()
+            group = ('unknown', unknown.group())
+        if pos >= end and not final:
+            return start
+        groups.append(group)
+    return pos
+
+
+def scanString(cleaned):
+    """
+    The 'fast' engine for parseString()
+    :param cleaned: USFM text that has already been through clean()
+    :return: list of token groups ready for createToken()
+    """
+    groups = []
+    scanGroups(cleaned.expandtabs(), groups) # pyparsing expands tabs in its input too
+    if not groups: # pyparsing wants OneOrMore(element)
+        raise ParseException(cleaned, 0, 'Expected element')
+    return groups
+
+
+engines = ('fast', 'pyparsing')
+
+# Change this whenever the grammar/scanner or the token groups it gives change
+#   so that any cached token streams are no longer used
+grammarVersion = 1
+
+# Set by enableCache() -- None means no caching
+parseCache = None
+
+
+def enableCache(directory=None, maxBytes=None):
+    """
+    Switches on the on-disk cache of parsed token streams for parseString()
+    :param directory: folder for the cache files (default is $USFM_PARSE_CACHE_DIR)
+    :param maxBytes: cap on the total size of the cache (default is $USFM_PARSE_CACHE_MAX_BYTES or 256MB)
+    :return: the ParseCache (for its hit/miss counters)
+    """
+    global parseCache
+    from .parseCache import ParseCache, defaultMaxBytes
+    if directory is None:
+        directory = os.environ['USFM_PARSE_CACHE_DIR']
+    if maxBytes is None:
+        maxBytes = int(os.environ.get('USFM_PARSE_CACHE_MAX_BYTES', defaultMaxBytes))
+    parseCache = ParseCache(directory, maxBytes)
+    return parseCache
+
+
+def disableCache():
+    global parseCache
+    parseCache = None
+
+
+def cacheKey(cleaned):
+    """
+    :return: SHA-256 hex digest of the grammar version and the cleaned USFM
+    """
+    return hashlib.sha256(f'{grammarVersion}\n{cleaned}'.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def parseString(unicodeString, engine='fast'):
     """
     version of parseString for use in libraries
     :param unicodeString:
+    :param engine: 'fast' (single-pass scanner) or 'pyparsing' (the original grammar)
+                    -- both give identical token lists
+                    (only 'fast' uses the cache, if enabled)
     :return:
     """
     cleaned = clean(unicodeString)
-    tokens = usfm.parseString(cleaned, parseAll=True)
+    if engine == 'fast':
+        if parseCache is None:
+            tokens = scanString(cleaned)
+        else:
+            key = cacheKey(cleaned)
+            tokens = parseCache.get(key)
+            if tokens is None:
+                tokens = scanString(cleaned)
+                parseCache.put(key, tokens)
+    elif engine == 'pyparsing':
+        tokens = usfm.parseString(cleaned, parseAll=True)
+    else:
+        raise ValueError(f"Unknown USFM parser engine '{engine}' -- expected one of {engines}")
     return [createToken(t) for t in tokens]
 
 
+def iterparse(source):
+    """
+    Generator version of parseString() (using the 'fast' engine)
+        that reads the USFM a line at a time, cleaning each line as it goes,
+        and yields each token as soon as it's complete
+        so only about one line (or marker) of the book is held in memory.
+    :param source: path of a USFM file, or an open text file object
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rt', encoding='utf-8') as usfm_file:
+            yield from iterparse(usfm_file)
+        return
+    buffer = ''
+    groups = []
+    nTokens = 0
+    for line in source:
+        # NOTE: clean() and expandtabs() never look past a newline so can be done line by line
+        buffer += clean(line).expandtabs()
+        buffer = buffer[scanGroups(buffer, groups, final=False):]
+        for group in groups:
+            yield createToken(group)
+        nTokens += len(groups)
+        groups.clear()
+    scanGroups(buffer, groups)
+    for group in groups:
+        yield createToken(group)
+    if not nTokens and not groups: # same as parseString()
+        raise ParseException(buffer, 0, 'Expected element')
+
+
+def compareEngines(unicodeString):
+    """
+    Parses the string with every engine
+    :return: None if all the token streams are identical, else a message about the first difference
+    """
+    streams = {}
+    for engine in engines:
+        streams[engine] = [(type(t).__name__, t.type, t.value) for t in parseString(unicodeString, engine)]
+    baseline = streams[engines[0]]
+    for engine in engines[1:]:
+        stream = streams[engine]
+        for n, (a, b) in enumerate(zip(baseline, stream)):
+            if a != b:
+                return f"Token {n}: {engines[0]} gave {a} but {engine} gave {b}"
+        if len(baseline) != len(stream):
+            return f"{engines[0]} gave {len(baseline)} tokens but {engine} gave {len(stream)}"
+    return None
+
+
 def clean(unicodeString):
     # We need to clean the input a bit. For a start, until
     # we work out what to do, non breaking spaces will be ignored
@@ -368,176 +605,32 @@ def clean(unicodeString):
 
 
 def createToken(t):
-    options = {
-        'id':   IDToken,
-        'ide':  IDEToken,
-        'usfm': USFMVersionToken,
-        'h':    HToken,
-
-        'mt':   MTToken,
-        'mt1':  MT1Token,
-        'mt2':  MT2Token,
-        'mt3':  MT3Token,
-
-        'ms':   MSToken,
-        'ms1':  MS1Token,
-        'ms2':  MS2Token,
-
-        'mr':   MRToken,
-        'p':    PToken,
-        'pc':   PCToken,
-
-        'pi':   PIToken,
-        'pi1':  PI1Token,
-        'pi2':  PI2Token,
-
-        'b':    BToken,
-
-        's':    SToken,
-        's1':   S1Token,
-        's2':   S2Token,
-        's3':   S3Token,
-        's4':   S4Token,
-
-        's5':   S5Token,
-
-        'sr':   SRToken,
-        'sts':  STSToken,
-        'mi':   MIToken,
-        'r':    RToken,
-        'c':    CToken,
-        'ca':   CAStartToken, 'ca*':  CAEndToken,
-        'cl':   CLToken,
-        'v':    VToken,
-        'va':   VAStartToken, 'va*':  VAEndToken,
-
-        'q':    QToken,
-        'q1':   Q1Token,
-        'q2':   Q2Token,
-        'q3':   Q3Token,
-        'q4':   Q4Token,
-
-        'qa':   QAToken,
-        'qac':  QACToken,
-        'qc':   QCToken,
-        'qm':   QMToken,
-        'qm1':  QM1Token,
-        'qm2':  QM2Token,
-        'qm3':  QM3Token,
-        'qr':   QRToken,
-        'qs':   QSStartToken,
-        'qs*':  QSEndToken,
-        'qt':   QTStartToken,
-        'qt*':  QTEndToken,
-        'nb':   NBToken,
-        'f':    FStartToken,
-        'fe':   FEStartToken,  # Footnote intended as an end note
-        'fr':   FRToken, 'fr*':  FREndToken,
-        'fk':   FKToken,
-        'ft':   FTToken, 'ft*':  FTEndToken,
-        'fq':   FQToken, 'fq*':  FQEndToken,
-        'fqa':  FQAToken, 'fqa*': FQAEndToken,
-        'fqb':  FQAEndToken,
-        'f*':   FEndToken,
-        'fe*':  FEEndToken,
-        'fv':   FVStartToken, 'fv*':  FVEndToken,
-        'fdc':  FDCStartToken, 'fdc*': FDCEndToken,
-        'fp':   FPToken,
-        'x':    XStartToken,
-        'xdc':  XDCStartToken, 'xdc*': XDCEndToken,
-        'xo':   XOToken,
-        'xt':   XTToken, 'xt*': XTEndToken,
-        'x*':   XEndToken,
-        'it':   ITStartToken, 'it*':  ITEndToken,
-        'bd':   BDStartToken, 'bd*':  BDEndToken,
-        'bdit': BDITStartToken, 'bdit*': BDITEndToken,
-
-        'li':   LIToken,
-        'li1':  LI1Token,
-        'li2':  LI2Token,
-        'li3':  LI3Token,
-        'li4':  LI4Token,
-
-        'd':    DToken,
-        'sp':   SPToken,
-        # 'i*':   IEndToken,
-        'add':  ADDStartToken, 'add*': ADDEndToken,
-        'nd':   NDStartToken, 'nd*':  NDEndToken,
-        'sc':   SCStartToken, 'sc*':  SCEndToken,
-        'wj':   WJStartToken, 'wj*':  WJEndToken,
-        'm':    MToken,
-        'tl':   TLStartToken, 'tl*':  TLEndToken,
-        '\\\\': EscapedToken,
-        'rem':  REMToken,
-
-        'tr':   TRToken,
-        'th1':  TH1Token,
-        'th2':  TH2Token,
-        'th3':  TH3Token,
-        'th4':  TH4Token,
-        'th5':  TH5Token,
-        'th6':  TH6Token,
-        'thr1': THR1Token,
-        'thr2': THR2Token,
-        'thr3': THR3Token,
-        'thr4': THR4Token,
-        'thr5': THR5Token,
-        'thr6': THR6Token,
-        'tc1':  TC1Token,
-        'tc2':  TC2Token,
-        'tc3':  TC3Token,
-        'tc4':  TC4Token,
-        'tc5':  TC5Token,
-        'tc6':  TC6Token,
-        'tcr1': TCR1Token,
-        'tcr2': TCR2Token,
-        'tcr3': TCR3Token,
-        'tcr4': TCR4Token,
-        'tcr5': TCR5Token,
-        'tcr6': TCR6Token,
-
-        'toc1': TOC1Token,
-        'toc2': TOC2Token,
-        'toc3': TOC3Token,
-
-        'is':   ISToken,
-        'is1':  IS1Token,
-        'is2':  IS2Token,
-        'is3':  IS3Token,
-
-        'imt':  IMTToken,
-        'imt1': IMT1Token,
-        'imt2': IMT2Token,
-        'imt3': IMT3Token,
-
-        'ie':   IEToken,
-        'ip':   IPToken,
-        'ipi':  IPIToken,
-        'im':   IMToken,
-        'imi':  IMIToken,
-        'iot':  IOTToken,
-        'io':   IOToken,
-        'io1':  IO1Token,
-        'io2':  IO2Token,
-        'ior':  IORStartToken, 'ior*': IOREndToken,
-        'bk':   BKStartToken, 'bk*':  BKEndToken,
-        'text': TEXTToken,
-        'unknown': UnknownToken
-    }
-    for k, v in options.items():
-        if t[0] == k:
-            if len(t) == 1:
-                token = v()
-            else:
-                token = v(t[1])
-            token.type = k
-            return token
-    raise Exception(t[0])
+    """
+    Makes the UsfmToken for a token group from either parser engine, e.g., ['v', '12'] or ('p',)
+    """
+    tokenClass = tokenClasses.get(t[0])
+    if tokenClass is None:
+        raise Exception(t[0])
+    token = tokenClass(t[1]) if len(t) > 1 else tokenClass()
+    token.type = t[0]
+    return token
+
 
 
+class UsfmTokenType(type):
+    """
+    Metaclass giving every token class empty __slots__ (unless it declares its own)
+        so that the many token objects for a book don't each carry a __dict__
+    """
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace)
+
 
 # noinspection PyMethodMayBeStatic
-class UsfmToken:
+class UsfmToken(metaclass=UsfmTokenType):
+    __slots__ = ('value', 'type')
+
     def __init__(self, value=''):
         self.value = value
         self.type = None
@@ -1323,3 +1416,186 @@ class BKStartToken(UsfmToken):
 class BKEndToken(UsfmToken):
     def renderOn(self, printer):  return printer.render_bk_e(self)
     def is_bk_e(self):            return True
+
+
+# Maps the first item of a token group (i.e., the USFM marker) to its token class
+tokenClasses = {
+    'id':   IDToken,
+    'ide':  IDEToken,
+    'usfm': USFMVersionToken,
+    'h':    HToken,
+
+    'mt':   MTToken,
+    'mt1':  MT1Token,
+    'mt2':  MT2Token,
+    'mt3':  MT3Token,
+
+    'ms':   MSToken,
+    'ms1':  MS1Token,
+    'ms2':  MS2Token,
+
+    'mr':   MRToken,
+    'p':    PToken,
+    'pc':   PCToken,
+
+    'pi':   PIToken,
+    'pi1':  PI1Token,
+    'pi2':  PI2Token,
+
+    'b':    BToken,
+
+    's':    SToken,
+    's1':   S1Token,
+    's2':   S2Token,
+    's3':   S3Token,
+    's4':   S4Token,
+
+    's5':   S5Token,
+
+    'sr':   SRToken,
+    'sts':  STSToken,
+    'mi':   MIToken,
+    'r':    RToken,
+    'c':    CToken,
+    'ca':   CAStartToken, 'ca*':  CAEndToken,
+    'cl':   CLToken,
+    'v':    VToken,
+    'va':   VAStartToken, 'va*':  VAEndToken,
+
+    'q':    QToken,
+    'q1':   Q1Token,
+    'q2':   Q2Token,
+    'q3':   Q3Token,
+    'q4':   Q4Token,
+
+    'qa':   QAToken,
+    'qac':  QACToken,
+    'qc':   QCToken,
+    'qm':   QMToken,
+    'qm1':  QM1Token,
+    'qm2':  QM2Token,
+    'qm3':  QM3Token,
+    'qr':   QRToken,
+    'qs':   QSStartToken,
+    'qs*':  QSEndToken,
+    'qt':   QTStartToken,
+    'qt*':  QTEndToken,
+    'nb':   NBToken,
+    'f':    FStartToken,
+    'fe':   FEStartToken,  # Footnote intended as an end note
+    'fr':   FRToken, 'fr*':  FREndToken,
+    'fk':   FKToken,
+    'ft':   FTToken, 'ft*':  FTEndToken,
+    'fq':   FQToken, 'fq*':  FQEndToken,
+    'fqa':  FQAToken, 'fqa*': FQAEndToken,
+    'fqb':  FQAEndToken,
+    'f*':   FEndToken,
+    'fe*':  FEEndToken,
+    'fv':   FVStartToken, 'fv*':  FVEndToken,
+    'fdc':  FDCStartToken, 'fdc*': FDCEndToken,
+    'fp':   FPToken,
+    'x':    XStartToken,
+    'xdc':  XDCStartToken, 'xdc*': XDCEndToken,
+    'xo':   XOToken,
+    'xt':   XTToken, 'xt*': XTEndToken,
+    'x*':   XEndToken,
+    'it':   ITStartToken, 'it*':  ITEndToken,
+    'bd':   BDStartToken, 'bd*':  BDEndToken,
+    'bdit': BDITStartToken, 'bdit*': BDITEndToken,
+
+    'li':   LIToken,
+    'li1':  LI1Token,
+    'li2':  LI2Token,
+    'li3':  LI3Token,
+    'li4':  LI4Token,
+
+    'd':    DToken,
+    'sp':   SPToken,
+    # 'i*':   IEndToken,
+    'add':  ADDStartToken, 'add*': ADDEndToken,
+    'nd':   NDStartToken, 'nd*':  NDEndToken,
+    'sc':   SCStartToken, 'sc*':  SCEndToken,
+    'wj':   WJStartToken, 'wj*':  WJEndToken,
+    'm':    MToken,
+    'tl':   TLStartToken, 'tl*':  TLEndToken,
+    '\\\\': EscapedToken,
+    'rem':  REMToken,
+
+    'tr':   TRToken,
+    'th1':  TH1Token,
+    'th2':  TH2Token,
+    'th3':  TH3Token,
+    'th4':  TH4Token,
+    'th5':  TH5Token,
+    'th6':  TH6Token,
+    'thr1': THR1Token,
+    'thr2': THR2Token,
+    'thr3': THR3Token,
+    'thr4': THR4Token,
+    'thr5': THR5Token,
+    'thr6': THR6Token,
+    'tc1':  TC1Token,
+    'tc2':  TC2Token,
+    'tc3':  TC3Token,
+    'tc4':  TC4Token,
+    'tc5':  TC5Token,
+    'tc6':  TC6Token,
+    'tcr1': TCR1Token,
+    'tcr2': TCR2Token,
+    'tcr3': TCR3Token,
+    'tcr4': TCR4Token,
+    'tcr5': TCR5Token,
+    'tcr6': TCR6Token,
+
+    'toc1': TOC1Token,
+    'toc2': TOC2Token,
+    'toc3': TOC3Token,
+
+    'is':   ISToken,
+    'is1':  IS1Token,
+    'is2':  IS2Token,
+    'is3':  IS3Token,
+
+    'imt':  IMTToken,
+    'imt1': IMT1Token,
+    'imt2': IMT2Token,
+    'imt3': IMT3Token,
+
+    'ie':   IEToken,
+    'ip':   IPToken,
+    'ipi':  IPIToken,
+    'im':   IMToken,
+    'imi':  IMIToken,
+    'iot':  IOTToken,
+    'io':   IOToken,
+    'io1':  IO1Token,
+    'io2':  IO2Token,
+    'ior':  IORStartToken, 'ior*': IOREndToken,
+    'bk':   BKStartToken, 'bk*':  BKEndToken,
+    'text': TEXTToken,
+    'unknown': UnknownToken
+}
+
+
+# The nightly builds switch the cache on for every tool that parses USFM by setting this
+if os.environ.get('USFM_PARSE_CACHE_DIR'):
+    enableCache()
+
+
+if __name__ == '__main__':
+    # Differential check of the parser engines over a corpus
+    #   e.g., python3 parseUsfm.py en_ult/ en_ust/
+    paths = []
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            paths.extend(sorted(os.path.join(arg, fname) for fname in os.listdir(arg) if fname.lower().endswith('.usfm')))
+        else:
+            paths.append(arg)
+    failures = 0
+    for path in paths:
+        with open(path, 'rt', encoding='utf-8') as book_file:
+            message = compareEngines(book_file.read())
+        if message:
+            failures += 1
+        print(f"{path}: {message if message else 'identical'}")
+    sys.exit(1 if failures else 0)
@@ -1,22 +1,44 @@
+import io
 import logging
 import re
 
 from .abstractRenderer import AbstractRenderer
 from .books import bookKeys, bookNames, silNames, readerNames, bookKeyForIdValue
-from .parseUsfm import UsfmToken
+from .parseUsfm import UsfmToken, clean, parseString
 
 #
 #   Simplest renderer. Ignores everything except ascii text.
 #
 
+# For predicting the state after each book (for rendering books in parallel)
+h_re = re.compile(r'\\h[ \t\r\n]+([^\n\\]*)')
+c_re = re.compile(r'\\c[ \t\r\n]+([0-9()-]+)[ \t\r\n]')
+v_re = re.compile(r'\\v[ \t\r\n]+([0-9()-]+)[ \t\r\n]')
+f_re = re.compile(r'\\f[ \t\r\n]')
+x_re = re.compile(r'\\x[ \t\r\n]')
+
+
 class SingleHTMLRenderer(AbstractRenderer):
-    def __init__(self, inputDir, outputFilename):
+    # These are set by renderID() at the start of every book
+    bookResetAttributes = ('cb', 'chapterLabel')
+
+    def __init__(self, inputDir=None, outputFilename=None, parallel=False, workers=None):
+        """
+        :param inputDir: folder of USFM files for render() (not needed for renderString())
+        :param outputFilename: HTML file for render() (not needed for renderString())
+        :param parallel: True to render the books in worker processes (the output is the same)
+        :param workers: how many worker processes (default is one for each CPU)
+        """
         # logging.debug(f"SingleHTMLRenderer.__init__( {inputDir}, {outputFilename} ) …")
         # Unset
         self.f = None  # output file stream
         # IO
         self.outputFilename = outputFilename
         self.inputDir = inputDir
+        self.parallel = parallel
+        self.workers = workers
+        self.includeHeader = True
+        self.includeChapterHeadings = True
         # Position
         self.cb = ''    # Current Book
         self.cc = '001'    # Current Chapter
@@ -55,7 +77,105 @@ class SingleHTMLRenderer(AbstractRenderer):
         return warning_list
 
 
+    def renderString(self, usfm, includeHeader=True, includeChapterHeadings=True):
+        """
+        Renders USFM text (a book or just a few verses) to HTML all in memory
+            (use a new renderer for each string as the footnote numbers, etc., carry on)
+        :param includeHeader: False to give just the body contents
+                                (without the HTML head, book name heading, or closing tags)
+        :param includeChapterHeadings: False to leave out the chapter headings
+        :return: the HTML (with any rendering warnings left in self.warning_list)
+        """
+        self.includeHeader = includeHeader
+        self.includeChapterHeadings = includeChapterHeadings
+        self.unknowns = []
+        self.warning_list = []
+        with io.StringIO() as self.f:
+            self.renderUSFM(usfm, self.warning_list)
+            self.closeString()
+            html = self.f.getvalue()
+        if self.unknowns:
+            logging.error(f"Renderer skipped {len(self.unknowns)} unknown USFM tokens: {', '.join(set(self.unknowns))}")
+        return html
+
+    def renderChunks(self, usfm, includeHeader=False, includeChapterHeadings=False):
+        """
+        Renders USFM made up of chunks that each start with a \\c (e.g., all the tN chunks of a book)
+            with one parse into one buffer, which is then sliced up at the chunk boundaries.
+        Each chunk comes out the same as renderString() would give (with the same options)
+            for the text before the first \\c (e.g., \\id and \\h) followed by just that chunk.
+        :return: list of the HTML for each chunk
+        """
+        self.includeHeader = includeHeader
+        self.includeChapterHeadings = includeChapterHeadings
+        self.unknowns = []
+        self.warning_list = []
+        tokens = parseString(usfm)
+        chunkStarts = [n for n, token in enumerate(tokens) if token.type == 'c']
+        chunkEnds = chunkStarts[1:] + [len(tokens)]
+        with io.StringIO() as self.f:
+            self.renderTokens(tokens[:chunkStarts[0]] if chunkStarts else tokens, self.warning_list)
+            startState = self.getBookState()
+            offsets = [self.f.tell()]
+            for start, end in zip(chunkStarts, chunkEnds):
+                # The only mutable state is dicts (of footnotes, etc.) so shallow copies are enough
+                self.__dict__.update({name: value.copy() if isinstance(value, (dict, list)) else value
+                                      for name, value in startState.items()})
+                self.renderTokens(tokens[start:end], self.warning_list)
+                self.closeString()
+                offsets.append(self.f.tell())
+            html = self.f.getvalue()
+        if self.unknowns:
+            logging.error(f"Renderer skipped {len(self.unknowns)} unknown USFM tokens: {', '.join(set(self.unknowns))}")
+        # Anything from the text before the first chunk goes in front of every chunk
+        return [html[:offsets[0]] + html[offsets[n]:offsets[n+1]] for n in range(len(offsets) - 1)]
+
+    def closeString(self):
+        if self.includeHeader: # The same as render()
+            self.writeFootnotes()
+            self.writeCrossReferences()
+            self.f.write('\n    </body>\n</html>\n')
+        else:
+            self.closeFragment()
+
+    def closeFragment(self):
+        # Close anything left open as the fragment might get put anywhere
+        self.closeFootnote()
+        self.closeCrossReference()
+        self.stopLI()
+        self.closeParagraph()
+        self.writeFootnotes()
+        self.writeCrossReferences()
+
+
+    def finishBook(self):
+        # What renderID() of the next book would do first
+        self.writeFootnotes()
+        self.writeCrossReferences()
+        self.closeParagraph()
+
+    def predictBookState(self, state, usfm):
+        cleaned = clean(usfm)
+        h_values = h_re.findall(cleaned)
+        if h_values:
+            state['bookName'] = h_values[-1]
+        last_c = None
+        for last_c in c_re.finditer(cleaned):
+            pass
+        if last_c:
+            state['cc'] = last_c.group(1).zfill(3)
+            state['footnote_num'] = 1 + len(f_re.findall(cleaned, last_c.end()))
+        else:
+            state['footnote_num'] += len(f_re.findall(cleaned))
+        v_values = v_re.findall(cleaned)
+        if v_values:
+            state['cv'] = v_values[-1].zfill(3)
+        state['crossReference_num'] += len(x_re.findall(cleaned))
+        return state
+
     def writeHeader(self):
+        if not self.includeHeader:
+            return
         h = """
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html lang="en" xmlns="http://www.w3.org/1999/xhtml">
@@ -276,8 +396,9 @@ class SingleHTMLRenderer(AbstractRenderer):
         self.writeCrossReferences()
         self.footnote_num = 1
         self.cc = token.value.zfill(3)
-        self.write('\n\n<h2 id="{0}-ch-{1}" class="c-num">{2} {3}</h2>'
-                   .format(self.cb, self.cc, self.chapterLabel, token.value))
+        if self.includeChapterHeadings:
+            self.write('\n\n<h2 id="{0}-ch-{1}" class="c-num">{2} {3}</h2>'
+                       .format(self.cb, self.cc, self.chapterLabel, token.value))
     def renderCA_S(self, token):
         assert not token.value
         self.write('<span class="altChapter">')
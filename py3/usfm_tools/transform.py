@@ -95,12 +95,13 @@ class UsfmTransform:
     #     c.render()
 
     @staticmethod
-    def buildSingleHtml(usfmDir, builtDir, buildName):
+    def buildSingleHtml(usfmDir, builtDir, buildName, parallel=False, workers=None):
         # UsfmTransform.__logger.debug("transform.buildSingleHtml( … ) …")
         # Convert to HTML
         UsfmTransform.__logger.debug("transform: building Single Page HTML…")
         UsfmTransform.ensureOutputDir(builtDir)
-        c = singlehtmlRenderer.SingleHTMLRenderer(usfmDir, builtDir + '/' + buildName + '.html')
+        c = singlehtmlRenderer.SingleHTMLRenderer(usfmDir, builtDir + '/' + buildName + '.html',
+                                                  parallel=parallel, workers=workers)
         warning_list = c.render()
         return warning_list
 
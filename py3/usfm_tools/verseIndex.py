@@ -0,0 +1,200 @@
+#
+# Chapter/verse offset index for USFM books
+#   so that the text of a verse (or range of verses) can be sliced out of the book
+#   without splitting the whole book on \c and \v every time.
+#
+# The index of a book file is kept in a small sidecar file next to it (or in a given folder)
+#   holding the SHA-256 of the book file followed by an array of (chapter, verse, start, end) byte offsets.
+# It's rebuilt whenever the book file no longer matches the hash.
+#
+
+import os
+import re
+import mmap
+import array
+import hashlib
+import logging
+import tempfile
+
+
+sidecarExtension = '.vidx'
+sidecarMagic = b'USFMVIDX1'
+hashSize = hashlib.sha256().digest_size
+
+# Verse number 0 is used for the span of the chapter itself (from its \c to the next \c)
+chapterVerse = 0
+
+markerPatterns = {str: re.compile(r'\\([cv]) '), bytes: re.compile(rb'\\([cv]) ')}
+numberPatterns = {str: re.compile(r'\d+'), bytes: re.compile(rb'\d+')}
+
+
+def scanVerses(text):
+    """
+    Finds the chapters and verses in the same way as splitting the book on '\\c ' and then '\\v '
+        -- any text before the first chapter is ignored
+        -- each number is the first one after the marker (a marker without one is ignored)
+    :param text: USFM str, or bytes (or mmap) of a UTF-8 USFM file
+    :return: list of (chapter, verse, start, end) tuples, in book order,
+                where verse is 0 (chapterVerse) for the chapter itself
+                and start is the offset of the marker
+    """
+    kind = str if isinstance(text, str) else bytes
+    chapterMarker = 'c' if kind is str else b'c'
+    numberPattern = numberPatterns[kind]
+    markers = [(match.start(), match.group(1)) for match in markerPatterns[kind].finditer(text)]
+    ends = [start for start, marker in markers[1:]] + [len(text)]
+    chapterEnd = len(text)
+    for n in reversed(range(len(markers))): # Each chapter runs up to the next \c
+        if markers[n][1] == chapterMarker:
+            ends[n], chapterEnd = chapterEnd, markers[n][0]
+    spans = []
+    chapter = None
+    for (start, marker), end in zip(markers, ends):
+        number = numberPattern.search(text, start, end)
+        if marker == chapterMarker:
+            chapter = int(number.group()) if number else None
+            if chapter is not None:
+                spans.append((chapter, chapterVerse, start, end))
+        elif chapter is not None and number:
+            spans.append((chapter, int(number.group()), start, end))
+    return spans
+
+
+def fileHash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as bookFile:
+        for block in iter(lambda: bookFile.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.digest()
+
+
+class VerseIndex:
+    """
+    The chapter/verse offsets of a USFM book file, e.g.,
+        VerseIndex('01-GEN.usfm').verse(12, 3)
+            or VerseIndex('01-GEN.usfm').verses(12, 3, 5)
+    """
+
+    def __init__(self, path, sidecarDir=None):
+        """
+        Loads the index from the sidecar file if it's still valid, otherwise builds and saves it
+        :param path: the USFM book file
+        :param sidecarDir: folder for the sidecar file (default is the folder of the book)
+        """
+        self.path = path
+        if sidecarDir is None:
+            self.sidecarPath = path + sidecarExtension
+        else:
+            self.sidecarPath = os.path.join(sidecarDir, os.path.basename(path) + sidecarExtension)
+        self.rebuilt = False
+        digest = fileHash(path)
+        self.offsets = self.loadSidecar(digest)
+        if self.offsets is None:
+            self.offsets = self.build()
+            self.saveSidecar(digest)
+            self.rebuilt = True
+        # (chapter, verse) -> row in self.offsets -- the last one wins if a book repeats a verse
+        self.rows = {}
+        for row in range(len(self.offsets) // 4):
+            self.rows[self.offsets[4 * row], self.offsets[4 * row + 1]] = row
+
+
+    def build(self):
+        offsets = array.array('I')
+        with open(self.path, 'rb') as bookFile:
+            if os.fstat(bookFile.fileno()).st_size == 0:
+                return offsets
+            with mmap.mmap(bookFile.fileno(), 0, access=mmap.ACCESS_READ) as text:
+                for span in scanVerses(text):
+                    offsets.extend(span)
+        return offsets
+
+
+    def loadSidecar(self, digest):
+        """
+        :return: the array of offsets from the sidecar file, or None if it's missing or out of date
+        """
+        try:
+            with open(self.sidecarPath, 'rb') as sidecarFile:
+                data = sidecarFile.read()
+        except FileNotFoundError:
+            return None
+        headerSize = len(sidecarMagic) + hashSize
+        if data[:len(sidecarMagic)] != sidecarMagic or data[len(sidecarMagic):headerSize] != digest:
+            return None
+        offsets = array.array('I')
+        if (len(data) - headerSize) % (4 * offsets.itemsize):
+            logging.warning(f"VerseIndex: ignoring bad sidecar file {self.sidecarPath}")
+            return None
+        offsets.frombytes(data[headerSize:])
+        return offsets
+
+
+    def saveSidecar(self, digest):
+        """
+        Writes the sidecar file (to a temporary file first so that nobody reads part of it)
+        """
+        directory = os.path.dirname(self.sidecarPath) or '.'
+        try:
+            fd, tempPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except OSError as e:
+            logging.warning(f"VerseIndex: unable to save {self.sidecarPath}: {e}")
+            return
+        try:
+            with os.fdopen(fd, 'wb') as tempFile:
+                tempFile.write(sidecarMagic + digest + self.offsets.tobytes())
+            os.replace(tempPath, self.sidecarPath)
+        except OSError as e:
+            logging.warning(f"VerseIndex: unable to save {self.sidecarPath}: {e}")
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+
+    def __contains__(self, chapterAndVerse):
+        return chapterAndVerse in self.rows
+
+
+    def chapters(self):
+        return [chapter for chapter, verse in self.rows if verse == chapterVerse]
+
+
+    def versesOf(self, chapter):
+        return [verse for c, verse in self.rows if c == chapter and verse != chapterVerse]
+
+
+    def span(self, chapter, verse):
+        """
+        :return: (start, end) byte offsets of the verse in the file (raises KeyError if it's not there)
+        """
+        row = self.rows[chapter, verse]
+        return self.offsets[4 * row + 2], self.offsets[4 * row + 3]
+
+
+    def read(self, start, end):
+        with open(self.path, 'rb') as bookFile:
+            bookFile.seek(start)
+            return bookFile.read(end - start).decode('utf-8')
+
+
+    def chapter(self, chapter):
+        """
+        :return: the USFM of the chapter, from its \\c marker up to the next one
+        """
+        return self.read(*self.span(chapter, chapterVerse))
+
+
+    def verse(self, chapter, verse):
+        """
+        :return: the USFM of the verse, from its \\v marker up to the next \\v or \\c
+        """
+        return self.read(*self.span(chapter, verse))
+
+
+    def verses(self, chapter, firstVerse, lastVerse):
+        """
+        :return: the USFM from the start of the first verse to the end of the last verse
+                    (including anything between them, e.g., section headings)
+        """
+        start = self.span(chapter, firstVerse)[0]
+        end = self.span(chapter, lastVerse)[1]
+        return self.read(start, max(start, end))
@@ -0,0 +1,191 @@
+#
+# Versification schemes as flat arrays
+#   so that chapter/verse counts and reference checks don't need to walk usfm_verses.verses.
+#
+# A scheme has one entry per chapter of every book (in canonical order) for its verse count
+#   and its cumulative verse offset, which gives every verse of the Bible its own ordinal number.
+# The bulk methods check whole arrays of references at once with NumPy (if it's installed).
+#
+
+import json
+import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError: # NumPy is optional -- the bulk methods then fall back to plain Python
+    numpy = None
+
+from . import usfm_verses
+
+
+defaultSchemeName = 'default'
+
+
+class Versification:
+
+    def __init__(self, books, name=defaultSchemeName):
+        """
+        :param books: dict of book id -> {'verses': [verse count of each chapter], ...}
+                        in the same layout as usfm_verses.verses (which is the default scheme)
+        """
+        self.name = name
+        self.bookIDs = list(books)
+        self.bookIndex = {bookID: n for n, bookID in enumerate(self.bookIDs)}
+        # The chapters of book n are chapterStarts[n] up to chapterStarts[n+1]
+        self.chapterStarts = array.array('l', [0])
+        self.verseCounts = array.array('l')
+        for bookID in self.bookIDs:
+            self.verseCounts.extend(books[bookID]['verses'])
+            self.chapterStarts.append(len(self.verseCounts))
+        # The verses of chapter n are numbered verseOffsets[n] + 1 up to verseOffsets[n+1]
+        self.verseOffsets = array.array('l', [0])
+        for count in self.verseCounts:
+            self.verseOffsets.append(self.verseOffsets[-1] + count)
+        if numpy is not None:
+            self.sortedBookIDs = numpy.array(sorted(self.bookIDs))
+            self.sortedBookIndexes = numpy.array([self.bookIndex[bookID] for bookID in self.sortedBookIDs.tolist()])
+            self.chapterStartsArray = numpy.array(self.chapterStarts)
+            self.verseCountsArray = numpy.array(self.verseCounts)
+            self.verseOffsetsArray = numpy.array(self.verseOffsets)
+
+
+    def __contains__(self, bookID):
+        return bookID in self.bookIndex
+
+
+    def __len__(self):
+        """
+        :return: total number of verses
+        """
+        return self.verseOffsets[-1]
+
+
+    def nChapters(self, bookID):
+        """
+        :return: number of chapters in the book (raises KeyError for an unknown book)
+        """
+        n = self.bookIndex[bookID]
+        return self.chapterStarts[n + 1] - self.chapterStarts[n]
+
+
+    def chapterIndex(self, bookID, chapter):
+        """
+        :return: index of the chapter in the flat arrays (raises KeyError if there's no such chapter)
+        """
+        n = self.bookIndex[bookID]
+        index = self.chapterStarts[n] + chapter - 1
+        if chapter < 1 or index >= self.chapterStarts[n + 1]:
+            raise KeyError(f"{bookID} {chapter}")
+        return index
+
+
+    def nVerses(self, bookID, chapter):
+        """
+        :return: number of verses in the chapter (raises KeyError if there's no such chapter)
+        """
+        return self.verseCounts[self.chapterIndex(bookID, chapter)]
+
+
+    def isValid(self, bookID, chapter, verse):
+        try:
+            return 1 <= verse <= self.nVerses(bookID, chapter)
+        except KeyError:
+            return False
+
+
+    def ordinal(self, bookID, chapter, verse):
+        """
+        :return: the position of the verse in the whole Bible, starting at 0 for GEN 1:1
+                    (raises KeyError if there's no such verse)
+        """
+        index = self.chapterIndex(bookID, chapter)
+        if verse < 1 or verse > self.verseCounts[index]:
+            raise KeyError(f"{bookID} {chapter}:{verse}")
+        return self.verseOffsets[index] + verse - 1
+
+
+    def reference(self, ordinal):
+        """
+        :return: the (bookID, chapter, verse) for an ordinal from ordinal()
+        """
+        if ordinal < 0 or ordinal >= len(self):
+            raise IndexError(f"Verse ordinal {ordinal} is out of range")
+        index = bisect_right(self.verseOffsets, ordinal) - 1
+        n = bisect_right(self.chapterStarts, index) - 1
+        return self.bookIDs[n], index - self.chapterStarts[n] + 1, ordinal - self.verseOffsets[index] + 1
+
+
+    def ordinals(self, bookIDs, chapters, verses):
+        """
+        Bulk version of ordinal() for arrays of references
+        :return: array of the ordinals, with -1 for any reference that isn't valid
+        """
+        if numpy is None:
+            return [self.ordinal(*reference) if self.isValid(*reference) else -1
+                    for reference in zip(bookIDs, chapters, verses)]
+        bookIDs = numpy.asarray(bookIDs, dtype=str)
+        chapters = numpy.asarray(chapters, dtype=numpy.int64)
+        verses = numpy.asarray(verses, dtype=numpy.int64)
+        found = numpy.searchsorted(self.sortedBookIDs, bookIDs)
+        found[found >= len(self.sortedBookIDs)] = 0
+        valid = self.sortedBookIDs[found] == bookIDs
+        books = numpy.where(valid, self.sortedBookIndexes[found], 0)
+        valid &= (chapters >= 1) & (chapters <= self.chapterStartsArray[books + 1] - self.chapterStartsArray[books])
+        index = numpy.where(valid, self.chapterStartsArray[books] + chapters - 1, 0)
+        valid &= (verses >= 1) & (verses <= self.verseCountsArray[index])
+        return numpy.where(valid, self.verseOffsetsArray[index] + verses - 1, -1)
+
+
+    def validate(self, bookIDs, chapters, verses):
+        """
+        Bulk version of isValid() for arrays of references
+        :return: array of bools
+        """
+        if numpy is None:
+            return [self.isValid(*reference) for reference in zip(bookIDs, chapters, verses)]
+        return self.ordinals(bookIDs, chapters, verses) >= 0
+
+
+    def validateRanges(self, bookIDs, chapters, firstVerses, lastVerses):
+        """
+        Checks arrays of verse ranges within a chapter, e.g., GEN 1:3-5
+        :return: array of bools -- True where both ends are valid and the first is not after the last
+        """
+        if numpy is None:
+            return [self.isValid(bookID, chapter, first) and self.isValid(bookID, chapter, last) and first <= last
+                    for bookID, chapter, first, last in zip(bookIDs, chapters, firstVerses, lastVerses)]
+        firsts = self.ordinals(bookIDs, chapters, firstVerses)
+        lasts = self.ordinals(bookIDs, chapters, lastVerses)
+        return (firsts >= 0) & (lasts >= firsts)
+# end of Versification class
+
+
+schemes = {}
+
+
+def registerScheme(name, books):
+    """
+    Adds an alternate versification scheme
+    :param books: dict in the same layout as usfm_verses.verses
+    :return: the Versification
+    """
+    schemes[name] = Versification(books, name)
+    return schemes[name]
+
+
+def loadScheme(name, path):
+    """
+    Adds an alternate versification scheme from a JSON file in the same layout as usfm_verses.verses
+    """
+    with open(path, 'rt', encoding='utf-8') as schemeFile:
+        return registerScheme(name, json.load(schemeFile))
+
+
+def getVersification(name=defaultSchemeName):
+    """
+    :return: the Versification for the scheme (the default one is built from usfm_verses.verses when first needed)
+    """
+    if name not in schemes and name == defaultSchemeName:
+        registerScheme(name, usfm_verses.verses)
+    return schemes[name]
@@ -7,18 +7,25 @@
 """
 Quick script to copy TW links out of UGNT 3 John and
     put into a TSV file with the same format (9 columns) as UTN.
+
+The links are read from an SQLite index of every x-tw link in the UHB and UGNT,
+    which is only rebuilt for a book when its source file changes,
+    so other scripts can also query it, e.g., get_tw_links('ROM', 8).
 """
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 import random
 import re
 import logging
+import sqlite3
 
 
 LOCAL_SOURCE_BASE_FOLDERPATH = Path('/mnt/Data/uW_dataRepos/')
 LOCAL_OT_SOURCE_FOLDERPATH = LOCAL_SOURCE_BASE_FOLDERPATH.joinpath('hbo_uhb/')
 LOCAL_NT_SOURCE_FOLDERPATH = LOCAL_SOURCE_BASE_FOLDERPATH.joinpath('el-x-koine_ugnt/')
 LOCAL_OUTPUT_FOLDERPATH = Path('/mnt/Data/uW_dataRepos/en_tw/')
+TW_INDEX_FILEPATH = LOCAL_SOURCE_BASE_FOLDERPATH.joinpath('tw_links_index.sqlite')
+TW_INDEX_VERSION = 1 # Increase this whenever get_source_lines() changes what it finds
 
 BBB_NUMBER_DICT = {'GEN':'01','EXO':'02','LEV':'03','NUM':'04','DEU':'05',
                     'JOS':'06','JDG':'07','RUT':'08','1SA':'09','2SA':'10','1KI':'11',
@@ -41,7 +48,17 @@ WORD_FIELD_RE = re.compile(r'(\\w .+?\\w\*)')
 SINGLE_WORD_RE = re.compile(r'\\w (.+?)\|')
 SIMPLE_TW_LINK_RE = re.compile(r'x-tw="([:/\*a-z0-9]+?)" \\w\*') # Only occurs inside a \\w field (at end)
 MILESTONE_TW_LINK_RE = re.compile(r'\\k-s \| ?x-tw="([:/\*a-z0-9]+?)" ?\\\*') # Only occurs inside a \\k-s field (at beginning)
-def get_source_lines(BBB:str, nn:str) -> Tuple[str,str,str,str,str,str,str]:
+def get_source_filepath(BBB:str, nn:str) -> Path:
+    """
+    Returns the path of the UHB or UGNT book
+    """
+    source_folderpath = LOCAL_OT_SOURCE_FOLDERPATH if int(nn)<40 \
+                    else LOCAL_NT_SOURCE_FOLDERPATH
+    return source_folderpath.joinpath(f'{nn}-{BBB}.usfm')
+# end of get_source_filepath function
+
+
+def get_source_lines(BBB:str, nn:str, with_milestones:bool=False) -> Tuple[str,str,str,str,str,str,str]:
     """
     Generator to read the UGNT book
         and return lines containing TW links.
@@ -49,14 +66,16 @@ def get_source_lines(BBB:str, nn:str) -> Tuple[str,str,str,str,str,str,str]:
     Returns a 5-tuple with:
         line number B C V reference strings
         actual line (without trailing nl)
+
+    If with_milestones is set, each tuple also has the number of the \\k-s milestone
+        that the link is (or is inside), counting from 1 in each book, or None.
     """
-    source_folderpath = LOCAL_OT_SOURCE_FOLDERPATH if int(nn)<40 \
-                    else LOCAL_NT_SOURCE_FOLDERPATH
-    source_filename = f'{nn}-{BBB}.usfm'
-    source_filepath = source_folderpath.joinpath(source_filename)
+    source_filepath = get_source_filepath(BBB, nn)
+    source_filename = source_filepath.name
 
     C = V = ''
     is_in_k = False
+    milestone_number = 0
     this_verse_words:List[str] = []
     with open(source_filepath, 'rt') as source_usfm_file:
         for line_number,line in enumerate(source_usfm_file, start=1):
@@ -90,6 +109,7 @@ def get_source_lines(BBB:str, nn:str) -> Tuple[str,str,str,str,str,str,str]:
             if '\\k-s' in line:
                 assert not is_in_k
                 is_in_k = True
+                milestone_number += 1
             # print(f"{line_number:4}/ {BBB} {C}:{V:<3} {is_in_k} {line}")
 
             # Make sure that the data looks like what we were expecting -- no surprises
@@ -120,7 +140,10 @@ def get_source_lines(BBB:str, nn:str) -> Tuple[str,str,str,str,str,str,str]:
                     assert milestone_words
                     milestone_words = ' '.join(milestone_words)
                     # print("here0", C,V, milestone_words, occurrence, milestone_link)
-                    yield remembered_line_number, BBB, C, V, milestone_words, occurrence, milestone_link
+                    if with_milestones:
+                        yield remembered_line_number, BBB, C, V, milestone_words, occurrence, milestone_link, milestone_number
+                    else:
+                        yield remembered_line_number, BBB, C, V, milestone_words, occurrence, milestone_link
                     del remembered_line_number, milestone_words, milestone_link # Don't let them persist -- just so we catch any logic errors
                     continue
             #     if '\\w ' in line:
@@ -155,11 +178,88 @@ def get_source_lines(BBB:str, nn:str) -> Tuple[str,str,str,str,str,str,str]:
                     word_link = simple_link_match.group(1)
                     assert word_link.startswith('rc://*/tw/dict/bible/')
                     # print("here2", C,V, word, occurrence, this_verse_words, word_link)
-                    yield line_number, BBB, C, V, word, occurrence, word_link
+                    if with_milestones:
+                        yield line_number, BBB, C, V, word, occurrence, word_link, milestone_number if is_in_k else None
+                    else:
+                        yield line_number, BBB, C, V, word, occurrence, word_link
                 word_field_match = WORD_FIELD_RE.search(line, word_field_match.end())
 # end of get_source_lines function
 
 
+def open_tw_index(index_filepath:Optional[Path]=None) -> sqlite3.Connection:
+    """
+    Opens (or creates) the index of x-tw links
+        starting it again if it was made by a different version of get_source_lines()
+
+    Default index_filepath is TW_INDEX_FILEPATH
+    """
+    connection = sqlite3.connect(str(index_filepath or TW_INDEX_FILEPATH))
+    if connection.execute('PRAGMA user_version').fetchone()[0] != TW_INDEX_VERSION:
+        connection.executescript('DROP TABLE IF EXISTS links; DROP TABLE IF EXISTS books;')
+        connection.execute(f'PRAGMA user_version = {TW_INDEX_VERSION}')
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS books (book TEXT PRIMARY KEY, source_size INTEGER, source_mtime INTEGER);
+        CREATE TABLE IF NOT EXISTS links (book TEXT, chapter INTEGER, verse INTEGER, line_number INTEGER,
+                        word TEXT, occurrence INTEGER, link TEXT, milestone INTEGER);
+        CREATE INDEX IF NOT EXISTS links_reference ON links (book, chapter, verse);
+        ''')
+    return connection
+# end of open_tw_index function
+
+
+def build_tw_index(books:Optional[Dict[str,str]]=None, index_filepath:Optional[Path]=None) -> int:
+    """
+    Brings the index up to date with the source books (default is all of BBB_NUMBER_DICT)
+        reading only the books whose source file has changed since they were indexed.
+
+    Returns the number of books that were (re)indexed.
+    """
+    if books is None: books = BBB_NUMBER_DICT
+    num_indexed = 0
+    with open_tw_index(index_filepath) as connection: # commits (or rolls back) the changes
+        indexed = {BBB:(size,mtime) for BBB,size,mtime in connection.execute('SELECT book, source_size, source_mtime FROM books')}
+        for BBB,nn in books.items():
+            source_stat = get_source_filepath(BBB, nn).stat()
+            if indexed.get(BBB) == (source_stat.st_size, source_stat.st_mtime_ns): continue
+            connection.execute('DELETE FROM links WHERE book=?', (BBB,))
+            connection.executemany('INSERT INTO links VALUES (?,?,?,?,?,?,?,?)',
+                ((BBB, int(C), int(V), line_number, word, occurrence, link, milestone)
+                    for line_number,BBB,C,V,word,occurrence,link,milestone in get_source_lines(BBB, nn, with_milestones=True)))
+            connection.execute('INSERT OR REPLACE INTO books VALUES (?,?,?)', (BBB, source_stat.st_size, source_stat.st_mtime_ns))
+            num_indexed += 1
+    connection.close()
+    return num_indexed
+# end of build_tw_index function
+
+
+def get_tw_links(BBB:str, C:Optional[int]=None, V:Optional[int]=None, index_filepath:Optional[Path]=None,
+                    with_milestones:bool=False) -> List[Tuple[int,str,str,str,str,int,str]]:
+    """
+    Returns the indexed x-tw links for the book (or just the chapter or verse)
+        as the same tuples (in the same order) as get_source_lines() generates,
+        e.g., get_tw_links('ROM', 8) for all the tW links in Romans 8.
+
+    NOTE: build_tw_index() needs to have been run for the book.
+    """
+    query = 'SELECT line_number, book, chapter, verse, word, occurrence, link, milestone FROM links WHERE book=?'
+    parameters = [BBB]
+    if C is not None:
+        query += ' AND chapter=?'
+        parameters.append(int(C))
+        if V is not None:
+            query += ' AND verse=?'
+            parameters.append(int(V))
+    connection = open_tw_index(index_filepath)
+    rows = connection.execute(query + ' ORDER BY rowid', parameters).fetchall()
+    connection.close()
+    if with_milestones:
+        return [(line_number,BBB,str(C),str(V),word,occurrence,link,milestone)
+                    for line_number,BBB,C,V,word,occurrence,link,milestone in rows]
+    return [(line_number,BBB,str(C),str(V),word,occurrence,link)
+                for line_number,BBB,C,V,word,occurrence,link,milestone in rows]
+# end of get_tw_links function
+
+
 def make_TSV_file(BBB:str, nn:str) -> Tuple[int,int]:
     """
     """
@@ -170,7 +270,8 @@ def make_TSV_file(BBB:str, nn:str) -> Tuple[int,int]:
     with open(output_filepath, 'wt') as output_TSV_file:
         output_TSV_file.write('Book	Chapter	Verse ID	SupportReference	OrigQuote	Occurrence	GLQuote	OccurrenceNote\n')
         previous_ids:List[str] = ['']
-        for j, (line_number,BBB,C,V,word,occurrence,link) in enumerate(get_source_lines(BBB, nn), start=1):
+        build_tw_index({BBB:nn}) # Does nothing if the book is already indexed
+        for j, (line_number,BBB,C,V,word,occurrence,link) in enumerate(get_tw_links(BBB), start=1):
             # print(f"{j:3}/ Line {line_number:<5} {BBB} {C:>3}:{V:<3} '{word}' {occurrence} {link}")
             generated_id = ''
             while generated_id in previous_ids:
@@ -191,6 +292,8 @@ def main():
     print("TW2tsv.py")
     print(f"  Source folderpath is {LOCAL_SOURCE_BASE_FOLDERPATH}")
     print(f"  Output folderpath is {LOCAL_OUTPUT_FOLDERPATH}")
+    print(f"  Index is {TW_INDEX_FILEPATH}")
+    print(f"    {build_tw_index():,} books (re)indexed")
     total_simple_links = total_complex_links = 0
     for BBB,nn in BBB_NUMBER_DICT.items():
         simple_count, complex_count = make_TSV_file(BBB,nn)
@@ -6,6 +6,8 @@
 # The usfm file must contain an \id field with the book ID.
 # The English RC folder is hard-coded in en_rc_dir.
 # The output folder is also hard-coded, in target_dir.
+# The books are converted in parallel processes (--jobs N, default is the number of CPUs):
+#   python alignment2rc.py [--jobs N] <source folder>
 
 import sys
 import os
@@ -24,6 +26,8 @@ import operator
 en_rc_dir = r'E:\Users\Larry\AppData\Local\translationstudio\library\resource_containers'
 target_dir = r'E:\DCS\Hindi\hi_irv'
 projects = []
+jobs = None     # Number of processes to convert books with (same as --jobs N); None for one per CPU
+quiet = False   # Set in worker processes, which leave the printing to the main process
 
 class State:
     ID = ""
@@ -86,7 +90,7 @@ class State:
             State.title = getDefaultName(State.ID)
             # Open output USFM file for writing.
             usfmPath = os.path.join(target_dir, makeUsfmFilename(State.ID))
-            State.usfmFile = io.open(usfmPath, "tw", buffering=1, encoding='utf-8', newline='\n')
+            State.usfmFile = io.open(usfmPath, "tw", encoding='utf-8', newline='\n')
         else:
             raise DuplicateBook(State.ID)
 
@@ -172,13 +176,27 @@ def takeMTX(key, value):
 
 token_re = re.compile(r'\\([^\t ]+)[\t ](.*)', re.UNICODE)
 
+# Returns the (marker, value) at the start of the line, as token_re would match them, or None.
+# The line is from readline(), so the only newline is at the end.
+def splitMarker(line):
+    if line[0:1] != '\\':
+        return None
+    space = line.find(' ', 1)
+    tab = line.find('\t', 1, space if space > 0 else len(line))
+    end = tab if tab > 0 else space
+    if end <= 1:
+        return None
+    value = line[end+1:]
+    if value[-1:] == '\n':
+        value = value[:-1]
+    return line[1:end], value
+
 # Parses the specified line and updates the state.
 def take(line):
-    token = token_re.match(line)
+    token = splitMarker(line)
     if token:
         state = State()
-        marker = token.group(1)
-        value = token.group(2)
+        marker, value = token
 
         if marker == "id":
             state.addID(value)
@@ -206,8 +224,8 @@ def take(line):
     global lastToken
     lastToken = token
 
-# Writes a corrected USFM header to the new USFM file, then writes the body.
-def writeUsfm(body):
+# Writes a corrected USFM header to the new USFM file.
+def writeHeader():
     state = State()
     state.optimizeTitles()
     # sys.stdout.write(u"Starting to write header.\n")
@@ -226,32 +244,54 @@ def writeUsfm(body):
     state.usfmFile.write('\n')
     state.usfmFile.write(state.postHeader)
     state.usfmFile.write('\n')
+
+# Writes a corrected USFM header to the new USFM file, then writes the body.
+def writeUsfm(body):
+    state = State()
+    writeHeader()
     for line in body:
         state.usfmFile.write(line)
     if line[-1] != '\n':
         state.usfmFile.write('\n')
     state.usfmFile.close()
 
+blockSize = 1024 * 1024
+
+# Writes a corrected USFM header to the new USFM file,
+# then copies the body from the input file in large blocks, starting with the first line of the body.
+# Gives the same file as writeUsfm() without holding the body in memory.
+def copyUsfm(line, input):
+    state = State()
+    writeHeader()
+    state.usfmFile.write(line)
+    last = line
+    block = input.read(blockSize)
+    while block:
+        state.usfmFile.write(block)
+        last = block
+        block = input.read(blockSize)
+    if last[-1] != '\n':
+        state.usfmFile.write('\n')
+    state.usfmFile.close()
+
 # Makes minor corrections to specified usfm file and copies to properly named usfm file at target_dir.
 def convertFile(usfmpath, fname):
     state = State()
     state.reset()
     
-    print("CONVERTING " + fname + ":")
-    sys.stdout.flush()
+    if not quiet:
+        print("CONVERTING " + fname + ":")
+        sys.stdout.flush()
     input = io.open(usfmpath, "tr", 1, encoding="utf-8")
     try:
         line = input.readline()
         while line[0:3] != "\\c ":
             take(line)
             line = input.readline()
-        body = []
-        body.append(line)
-        body += input.readlines()    # read the remainder of the usfm file
-        input.close
-        writeUsfm(body)
+        copyUsfm(line, input)       # the remainder of the usfm file
+        input.close()
     except DuplicateBook as dup:
-        input.close
+        input.close()
         raise
         printError("Multiple SFM files for book: " + str(dup))
     return True
@@ -259,6 +299,10 @@ def convertFile(usfmpath, fname):
 # Appends information about the current book to the global projects list.
 def appendToProjects():
     global projects
+    projects.append(makeProject())
+
+# Returns the projects list entry for the current book.
+def makeProject():
     state = State()
 
     sort = usfm_verses.verseCounts[state.ID]["sort"]
@@ -268,7 +312,7 @@ def appendToProjects():
     project = { "title": state.title, "id": state.ID.lower(), "sort": str(sort), \
                 "path": "./" + makeUsfmFilename(state.ID), \
                 "categories": "[ 'bible-" + testament + "' ]" }
-    projects.append(project)
+    return project
 
 # Converts the book or books contained in the specified folder
 def convertFolder(folder):
@@ -290,6 +334,72 @@ def convertFolder(folder):
             except DuplicateBook as dup:
                 printError("Multiple SFM files for book: " + str(dup))
             
+# Returns the .usfm files under the specified folder, as (path, file name) pairs
+# in the order that convertFolder() converts them.
+def findUsfmFiles(folder):
+    files = []
+    for fname in os.listdir(folder):
+        path = os.path.join(folder, fname)
+        if os.path.isdir(path) and fname[0] != '.':
+            files += findUsfmFiles(path)
+        elif fname[-3:].lower() == 'sfm':
+            files.append((path, fname))
+    return files
+
+# Returns the book ID that convertFile() would take from the \id line in the file header, or "" if none.
+def sniffID(path):
+    with io.open(path, "tr", encoding="utf-8") as input:
+        line = input.readline()
+        while line and line[0:3] != "\\c ":
+            token = splitMarker(line)
+            if token and token[0] == "id":
+                return token[1][0:3].upper() if len(token[1]) >= 3 else ""
+            line = input.readline()
+    return ""
+
+# Sets the globals for converting books in a worker process.
+def initWorker(targetDir):
+    global target_dir, quiet
+    target_dir = targetDir
+    quiet = True
+
+# Converts one book in a worker process and returns its projects list entry.
+def convertFileInWorker(path, fname):
+    convertFile(path, fname)
+    return makeProject()
+
+# Converts the book or books contained in the specified folder, nJobs books at a time.
+# Only the first file for each book is converted, and the messages and projects list
+# are the same, and in the same order, as from convertFolder().
+def convertBooks(folder, nJobs):
+    if not os.path.isdir(folder):
+        printError("Invalid folder path given: " + folder)
+        return
+    if not os.path.isdir(target_dir):
+        os.mkdir(target_dir)
+    files = findUsfmFiles(folder)
+    if nJobs == 1 or len(files) < 2:
+        convertFolder(folder)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=nJobs, initializer=initWorker, initargs=(target_dir,)) as executor:
+        ids = set(p['id'].upper() for p in projects)
+        futures = []
+        for path, fname in files:
+            id = sniffID(path)
+            if id in ids:
+                futures.append(None)    # a duplicate
+            else:
+                ids.add(id)
+                futures.append(executor.submit(convertFileInWorker, path, fname))
+        for (path, fname), future in zip(files, futures):
+            print("CONVERTING " + fname + ":")
+            sys.stdout.flush()
+            if future is None:
+                printError("Multiple SFM files for book: " + sniffID(path))
+            else:
+                projects.append(future.result())
+
 # Sort the list of projects and write to projects.yaml
 def dumpProjects():
     global projects
@@ -314,10 +424,16 @@ def printError(text):
 if __name__ == "__main__":
     if os.path.isfile( makeManifestPath() ):
         os.remove( makeManifestPath() )
-    if len(sys.argv) < 2 or sys.argv[1] == 'hard-coded-path':
-         convertFolder(r'E:\DCS\Hindi\IRV.newest')
+    args = sys.argv[1:]
+    if '--jobs' in args:
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    nJobs = jobs or os.cpu_count() or 1
+    if len(args) < 1 or args[0] == 'hard-coded-path':
+         convertBooks(r'E:\DCS\Hindi\IRV.newest', nJobs)
     else:       # the first command line argument is presumed to be the folder containing usfm files to be converted
-        convertFolder(sys.argv[1])
+        convertBooks(args[0], nJobs)
     dumpProjects()
 
     print("\nDone.")
@@ -338,6 +338,59 @@ def parseString(unicodeString):
         sys.exit()
     return [createToken(t) for t in tokens]
 
+# Generator version of parseString() that reads the USFM (an open text file) a line at a time
+# and yields each token as soon as it's complete, so only about one line of the book is held in memory.
+# Each token also gets a spaceBefore attribute: True if there was whitespace between it and the token before it
+# in the USFM (which the tokens themselves leave out, e.g., after an end marker or a line break).
+def iterparse(source):
+    buffer = ''
+    nTokens = 0
+    for line in source:
+        # clean() and expandtabs() (which pyparsing does to its input) never look past a newline
+        buffer += clean(line).expandtabs()
+        spans = scanSpans(buffer)
+        # The last token might still carry on into the next line (e.g., '\v 1' might become '\v 12')
+        # so it's scanned again with that line (along with the whitespace before it)
+        pos = 0
+        for t, start, end in spans[:-1]:
+            yield spacedToken(t, start > pos)
+            pos = end
+        buffer = buffer[pos:]
+        nTokens += len(spans[:-1])
+    spans = scanSpans(buffer)
+    if (not nTokens and not spans) or buffer[spans[-1][2] if spans else 0:].strip(' \t\r\n'):
+        parseError(buffer)
+    pos = 0
+    for t, start, end in spans:
+        yield spacedToken(t, start > pos)
+        pos = end
+
+# Returns (token group, start, end) for each token in the string,
+# exiting as parseString() does at anything that isn't a token (which scanString() would skip over)
+def scanSpans(s):
+    spans = []
+    pos = 0
+    for tokens, start, end in element.scanString(s):
+        if s[pos:start].strip(' \t\r\n'):
+            parseError(s[pos:])
+        spans.append((tokens[0], start, end))
+        pos = end
+    return spans
+
+# Reports a string that doesn't parse in the same way as parseString()
+def parseError(s):
+    try:
+        usfm.parseString(s, parseAll=True)
+    except Exception as e:
+        print(e)
+    print(repr(s[:50]))
+    sys.exit()
+
+def spacedToken(t, spaceBefore):
+    token = createToken(t)
+    token.spaceBefore = spaceBefore
+    return token
+
 #def parseString(unicodeString):
 #    """
 #    version of parseString for use in libraries
@@ -8,6 +8,8 @@
 # The English RC folder is hard-coded in en_rc_dir.
 # The output folder is also hard-coded.
 # The input file(s) should be verified, correct USFM.
+# The books are converted in parallel processes (--jobs N, default is the number of CPUs):
+#   python usfm2rc.py [--jobs N] <source folder>
 
 # Global variables
 en_rc_dir = r'C:\Users\lvers\AppData\Local\BTT-Writer\library\resource_containers'
@@ -15,6 +17,9 @@ target_dir = r'E:\DCS\Bangwinji\tmp'
 source_dir = r'E:\DCS\Bangwinji'
 projects = []
 lastToken = None
+jobs = None             # Number of processes to convert books with (same as --jobs N); None for one per CPU
+chunkIndex = None       # (book ID, chapter) -> chunk verse numbers, from loadChunkIndex()
+collectedErrors = None  # Errors are collected here instead of printed while converting in a worker
 
 import sys
 import os
@@ -157,7 +162,10 @@ class State:
 chunk_re = re.compile(r'([0-9]{2,3}).usx')
 
 # Makes an ordered list of the verse numbers that starts the chunks in the specified book and chapter
+# Uses the chunk index if it has been loaded.
 def loadChunks(id, chap):
+    if chunkIndex is not None and (id.upper(), chap) in chunkIndex:
+        return list(chunkIndex[(id.upper(), chap)])
     dir = os.path.join(en_rc_dir, "en_" + id + "_ulb")
     dir = os.path.join(dir, "content")
     dir = os.path.join(dir, chap)
@@ -170,6 +178,33 @@ def loadChunks(id, chap):
     chunks.sort()
     return chunks
 
+book_rc_re = re.compile(r'en_(.+)_ulb$')
+
+# Scans the chapter folders of every English ULB resource container in en_rc_dir once,
+# returning the same chunk lists as loadChunks() for each (book ID, chapter).
+def loadChunkIndex():
+    index = {}
+    if not os.path.isdir(en_rc_dir):
+        return index
+    with os.scandir(en_rc_dir) as rcs:
+        for rc in rcs:
+            match = book_rc_re.match(rc.name)
+            contentDir = os.path.join(rc.path, "content")
+            if not match or not os.path.isdir(contentDir):
+                continue
+            with os.scandir(contentDir) as chapters:
+                for chapter in chapters:
+                    if chapter.is_dir():
+                        chunks = []
+                        with os.scandir(chapter.path) as names:
+                            for name in names:
+                                chunk = chunk_re.match(name.name)
+                                if chunk:
+                                    chunks.append( int(chunk.group(1)) )
+                        chunks.sort()
+                        index[(match.group(1).upper(), chapter.name)] = chunks
+    return index
+
 # Returns path name for usfm file
 def makeUsfmFilename(id):
     # loadVerseCounts()
@@ -394,8 +429,9 @@ def convertFile(usfmpath, fname):
     str = input.read(-1)
     input.close
 
-    print("CONVERTING " + fname + ":")
-    sys.stdout.flush()
+    if collectedErrors is None:
+        print("CONVERTING " + fname + ":")
+        sys.stdout.flush()
     success = isParseable(str, fname)
     if success:
         for token in parseUsfm.parseString(str):
@@ -421,9 +457,114 @@ def convertFolder(folder):
             else:
                 printError("File cannot be converted: " + fname)
                 
+# Returns the .usfm files under the specified folder, as (path, file name) pairs
+# in the order that convertFolder() converts them.
+def findUsfmFiles(folder):
+    files = []
+    for fname in os.listdir(folder):
+        path = os.path.join(folder, fname)
+        if os.path.isdir(path):
+            files += findUsfmFiles(path)
+        elif fname[-3:].lower() == 'sfm':
+            files.append((path, fname))
+    return files
+
+# Sets the globals for converting books in a worker process.
+def initWorker(rcDir, targetDir, index):
+    global en_rc_dir, target_dir, chunkIndex
+    en_rc_dir = rcDir
+    target_dir = targetDir
+    chunkIndex = index
+
+# Converts one book, collecting its errors instead of printing them.
+# Returns the errors, the book's project entry (None if it couldn't be converted),
+# and the exit code if the conversion called sys.exit().
+def convertFileInWorker(path, fname):
+    global collectedErrors
+    collectedErrors = []
+    project = None
+    exitCode = None
+    errors = collectedErrors
+    try:
+        if convertFile(path, fname):
+            project = makeProject()
+        else:
+            printError("File cannot be converted: " + fname)
+    except SystemExit as e:
+        exitCode = e.code
+    finally:
+        collectedErrors = None
+    return errors, project, exitCode
+
+# Returns the book ID (first 3 characters of the \id value, upper case) of the specified usfm file,
+# reading no further than the first chapter. Returns "" if the ID is not found.
+def sniffID(path):
+    with io.open(path, "tr", encoding="utf-8-sig") as input:
+        line = input.readline()
+        while line and not line.lstrip().startswith("\\c "):
+            words = line.split(None, 2)
+            if len(words) > 1 and words[0] == "\\id":
+                return words[1][0:3].upper()
+            line = input.readline()
+    return ""
+
+# Converts the book or books contained in the specified folder, nJobs books at a time.
+# The English chunk folders are scanned just once, up front.
+# Only the first file for each book ID is converted, so that no two workers write the same .usfm file;
+# the others are reported. Otherwise the messages and projects list are the same, and in the same order,
+# as from convertFolder().
+def convertBooks(folder, nJobs):
+    global chunkIndex
+    if not os.path.isdir(folder):
+        printError("Invalid folder path given: " + folder)
+        return
+    if not os.path.isdir(target_dir):
+        os.mkdir(target_dir)
+    chunkIndex = loadChunkIndex()
+    files = findUsfmFiles(folder)
+    ids = set()
+    duplicates = set()
+    for path, fname in files:
+        id = sniffID(path)
+        if id and id in ids:
+            duplicates.add(path)
+        ids.add(id)
+    if nJobs == 1 or len(files) < 2:
+        reportBooks(files, [None if path in duplicates else (lambda path=path, fname=fname: convertFileInWorker(path, fname))
+                            for path, fname in files])
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nJobs, initializer=initWorker,
+                                 initargs=(en_rc_dir, target_dir, chunkIndex)) as executor:
+            futures = [None if path in duplicates else executor.submit(convertFileInWorker, path, fname)
+                       for path, fname in files]
+            reportBooks(files, [future and future.result for future in futures])
+
+# Reports the results of each book in order, adding it to the projects list.
+# getResults are the functions that return the convertFileInWorker() result for each file,
+# or None for a file that wasn't converted because an earlier file has the same book ID.
+def reportBooks(files, getResults):
+    for (path, fname), getResult in zip(files, getResults):
+        print("CONVERTING " + fname + ":")
+        sys.stdout.flush()
+        if getResult is None:
+            printError("Multiple SFM files for book: " + sniffID(path))
+            continue
+        errors, project, exitCode = getResult()
+        for error in errors:
+            printError(error)
+        if exitCode is not None:
+            sys.exit(exitCode)
+        if project:
+            projects.append(project)
+
 # Appends information about the current book to the global projects list.
 def appendToProjects():
     global projects
+    projects.append(makeProject())
+
+# Returns the projects list entry for the current book.
+def makeProject():
     state = State()
 
     sort = usfm_verses.verseCounts[state.ID]["sort"]
@@ -433,7 +574,7 @@ def appendToProjects():
     project = { "title": state.title, "id": state.ID.lower(), "sort": sort, \
                 "path": "./" + makeUsfmFilename(state.ID), \
                 "categories": "[ 'bible-" + testament + "' ]" }
-    projects.append(project)
+    return project
 
 # Sort the list of projects and write to projects.yaml
 def dumpProjects():
@@ -453,14 +594,22 @@ def dumpProjects():
     manifest.close()
 
 def printError(text):
+    if collectedErrors is not None:
+        collectedErrors.append(text)
+        return
     sys.stderr.write(text + '\n')
 
 # Processes each directory and its files one at a time
 if __name__ == "__main__":
     if os.path.isfile( makeManifestPath() ):
         os.remove( makeManifestPath() )
-    if len(sys.argv) > 1 and sys.argv[1] != 'hard-coded-path':
-        source_dir = sys.argv[1]
-    convertFolder(source_dir)
+    args = sys.argv[1:]
+    if '--jobs' in args:
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    if len(args) > 0 and args[0] != 'hard-coded-path':
+        source_dir = args[0]
+    convertBooks(source_dir, jobs or os.cpu_count() or 1)
     dumpProjects()
     print("\nDone.")
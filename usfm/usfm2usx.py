@@ -12,6 +12,10 @@
 # The output, target language RC is also hard-coded and may need to be changed for each run of this script.
 # Both content folders must exist before the script will run.
 
+# With --usx, converts a .usfm file, or every .usfm file in a folder, to one plain .usx file per book instead,
+# converting the books in parallel processes (--jobs N, default is the number of CPUs):
+#   python usfm2usx.py --usx [--jobs N] <.usfm file or folder> <target folder>
+
 import sys
 import os
 
@@ -320,6 +324,207 @@ def convertFile(filename):
     print("  No English carried over to the target .usx files. (grep -i 'the ' ...)")
     print("  <para> and </para> nodes should be balanced in target .usx files.")
 
+# Plain USX export (--usx)
+# Converts whole books to one .usx file each, without the English resource container templates.
+# UsxWriter keeps its own state so that books can be converted in separate processes at once,
+# and writes each element as soon as its token is taken so that nothing accumulates in memory.
+
+# Character styles that have an end marker
+charStyles = {'ca', 'va', 'k', 'qs', 'qt', 'wj', 'tl', 'it', 'bd', 'bdit', 'add', 'nd', 'pn', 'sc', 'ior', 'bk',
+              'fv', 'fdc', 'xdc'}
+noteStyles = {'f', 'fe', 'x'}
+# Footnote and cross reference parts that hold their text as the token value
+noteCharStyles = {'fr', 'fk', 'ft', 'fq', 'fqa', 'fqb', 'fp', 'xo', 'xq', 'xt'}
+# Book-level markers that USX leaves out
+skippedStyles = {'usfm'}
+# Paragraph markers that never have any content
+emptyParaStyles = {'b', 'ie'}
+cellStyles_re = re.compile(r'(th|thr|tc|tcr)[1-6]$')
+
+def escapeXml(t):
+    return t.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def endsWord(t):
+    return t[-1:] != '' and not t[-1].isspace()
+
+class UsxWriter:
+    def __init__(self, output):
+        self.output = output    # an open text file
+        self.para = None        # style of the open <para>
+        self.inline = []        # styles of the open <char> and <note> elements, innermost last
+        self.inTable = False
+        self.inRow = False
+        self.inCell = False
+        self.wordEnd = False    # whether the last thing written was text that didn't end in whitespace
+        self.output.write('<?xml version="1.0" encoding="utf-8"?>\n<usx version="2.0">\n')
+
+    def write(self, t):
+        self.output.write(t)
+
+    def closeInline(self):
+        while self.inline:
+            style = self.inline.pop()
+            self.write('</note>' if style in noteStyles else '</char>')
+
+    def closePara(self):
+        self.closeInline()
+        if self.inCell:
+            self.write('</cell>')
+            self.inCell = False
+        if self.inRow:
+            self.write('</row>\n')
+            self.inRow = False
+        if self.para:
+            self.write('</para>\n')
+            self.para = None
+
+    def closeTable(self):
+        self.closePara()
+        if self.inTable:
+            self.write('</table>\n')
+            self.inTable = False
+
+    def openPara(self, style, value=''):
+        self.closeTable()
+        self.write('<para style="' + style + '">' + escapeXml(value))
+        self.para = style
+        self.wordEnd = endsWord(value)
+
+    # Starts a table row, and the table if this is its first row.
+    def openRow(self):
+        self.closePara()
+        if not self.inTable:
+            self.write('<table>\n')
+            self.inTable = True
+        self.write('<row style="tr">')
+        self.inRow = True
+
+    # Starts a table cell, and the row if the cell isn't in one.
+    def openCell(self, style):
+        if not self.inRow:
+            self.openRow()
+        self.closeInline()
+        if self.inCell:
+            self.write('</cell>')
+        align = 'end' if style[2] == 'r' else 'start'
+        self.write('<cell style="' + style + '" align="' + align + '">')
+        self.inCell = True
+
+    # Makes sure there's an element for text to go in:
+    # a cell if we're in a table row, otherwise a paragraph.
+    def openContent(self):
+        if self.inRow:
+            if not self.inCell:
+                self.openCell('tc1')
+        elif not self.para:
+            self.openPara('p')
+
+    # Writes the USX for one token (from parseUsfm.iterparse()).
+    def take(self, token):
+        style = token.type
+        value = token.value
+        # The tokens leave out the whitespace between them, e.g., after an end marker or at the end of a line,
+        # so it's put back where it separates words
+        if token.spaceBefore and self.wordEnd and (style == 'text' or style in charStyles or style in noteStyles):
+            self.write(' ')
+        if style == 'text' or style == '\\\\':
+            self.openContent()
+            text = '\\' if style == '\\\\' else value
+            self.write(escapeXml(text))
+            self.wordEnd = endsWord(text)
+            return
+        self.wordEnd = False
+        if style == 'id':
+            self.closeTable()
+            self.write('<book code="' + escapeXml(value[0:3]) + '" style="id">' + escapeXml(value[3:].strip()) + '</book>\n')
+        elif style == 'c':
+            self.closeTable()
+            self.write('<chapter number="' + escapeXml(value) + '" style="c" />\n')
+        elif style == 'v':
+            self.openContent()
+            self.write('\n  <verse number="' + escapeXml(value) + '" style="v" />')
+        elif style in charStyles or style in noteStyles:
+            self.openContent()
+            if style in noteStyles:
+                self.write('<note caller="' + escapeXml(value or '+') + '" style="' + style + '">')
+            else:
+                self.write('<char style="' + style + '">')
+            self.inline.append(style)
+        elif style.endswith('*'):
+            style = style[:-1]
+            if style in self.inline:
+                while self.inline:
+                    inner = self.inline.pop()
+                    self.write('</note>' if inner in noteStyles else '</char>')
+                    if inner == style:
+                        break
+            self.wordEnd = True
+        elif style in noteCharStyles:
+            self.write('<char style="' + style + '">' + escapeXml(value) + '</char>')
+            self.wordEnd = endsWord(value)
+        elif style == 'tr':
+            self.openRow()
+        elif cellStyles_re.match(style):
+            self.openCell(style)
+        elif style in emptyParaStyles:
+            self.closeTable()
+            self.write('<para style="' + style + '" />\n')
+        elif style == 'unknown':
+            sys.stderr.write("Unknown marker \\" + value + " left out of USX\n")
+        elif style not in skippedStyles:
+            self.openPara(style, value)
+
+    def close(self):
+        self.closeTable()
+        self.write('</usx>\n')
+
+# Converts one USFM file to a USX file, a token at a time.
+# Runs in a worker process when converting a folder with --jobs.
+# Returns an error message, or None if it was converted.
+def convertBookToUsx(source, target):
+    try:
+        # Written to a temporary file first so that a failed book doesn't leave part of a .usx file
+        with io.open(source, "tr", encoding="utf-8-sig") as input, \
+                io.open(target + ".tmp", "tw", encoding="utf-8", newline='\n') as output:
+            writer = UsxWriter(output)
+            for token in parseUsfm.iterparse(input):
+                writer.take(token)
+            writer.close()
+        os.replace(target + ".tmp", target)
+    except (Exception, SystemExit) as e:    # parseUsfm.iterparse() exits on a parse error
+        if os.path.exists(target + ".tmp"):
+            os.remove(target + ".tmp")
+        return "Unable to convert " + source + ": " + repr(e)
+    return None
+
+# Returns the (source, target) paths of each USFM book to convert to USX.
+def usxPaths(source, targetDir):
+    if os.path.isfile(source):
+        sources = [source]
+    else:
+        sources = sorted(os.path.join(source, name) for name in os.listdir(source)
+                         if name[0] != '.' and name[-3:].lower() == 'sfm' and os.path.isfile(os.path.join(source, name)))
+    return [(path, os.path.join(targetDir, os.path.splitext(os.path.basename(path))[0] + ".usx")) for path in sources]
+
+# Converts a USFM file, or all the USFM files in a folder, to USX files in the target folder.
+# Books are converted in nJobs processes at once.
+def convertToUsx(source, targetDir, nJobs):
+    if not os.path.isdir(targetDir):
+        os.makedirs(targetDir)
+    paths = usxPaths(source, targetDir)
+    if nJobs > 1 and len(paths) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nJobs) as executor:
+            futures = [executor.submit(convertBookToUsx, src, target) for src, target in paths]
+            errors = [future.result() for future in futures]
+    else:
+        errors = [convertBookToUsx(src, target) for src, target in paths]
+    for (src, target), error in zip(paths, errors):
+        if error:
+            sys.stderr.write(error + "\n")
+        else:
+            print("Converted " + src + " to " + target)
+
 # Verifies the global content directory variables.
 # Prints error message if either directory does not exist or has other problems.
 # Returns True or False
@@ -368,7 +573,22 @@ def buildOutContentFolder():
 
     
 if __name__ == "__main__":
-    if content_dirs_ok():
+    args = sys.argv[1:]
+    if '--usx' in args:
+        # Plain USX export: usfm2usx.py --usx [--jobs N] <.usfm file or folder> <target folder>
+        args.remove('--usx')
+        jobs = os.cpu_count() or 1
+        if '--jobs' in args:
+            i = args.index('--jobs')
+            jobs = int(args[i + 1])
+            del args[i:i + 2]
+        if len(args) < 2:
+            print("Usage: usfm2usx.py --usx [--jobs N] <.usfm file or folder> <target folder>")
+        elif os.path.exists(args[0]):
+            convertToUsx(args[0], args[1], jobs)
+        else:
+            print("USFM input not found: " + args[0])
+    elif content_dirs_ok():
         if len(sys.argv) < 2:
             source = raw_input("Enter path to .usfm file: ")
         elif sys.argv[1] == 'hard-coded-path':
@@ -2,18 +2,26 @@
 # Script for verifying proper USFM.
 # Reports errors to stderr and issues.txt.
 # Set source_dir and usfmVersion to run.
+# Use --jobs N to check the files of a folder in N processes at once.
+# Use --incremental to only check the files of a folder that changed since the last --incremental run.
+# Use --cache PATH to say where --incremental keeps its results.
 
 # Global variables
 source_dir = r'C:\DCS\Bangwinji\bsj_reg'
 usfmVersion = 2     # if version 3.0 or greater, tolerates unknown tokens and verse fragments
 suppress1 = False      # Suppress warnings about empty verses and verse fragments
 suppress9 = True       # Suppress warnings about ASCII content
+jobs = 1               # Number of processes to check files with (same as --jobs N)
+incremental = False    # Reuse the results for unchanged files from the last run (same as --incremental)
+cachePath = None       # JSON file where --incremental keeps its results (same as --cache PATH); None for one in ~/.cache
 
 if usfmVersion >= 3.0:
     suppress1 = True
 
 lastToken = None
 issuesFile = None
+collectedIssues = None  # Set by a worker process to collect its errors instead of reporting them
+dependsOnLastFile = False   # Set if the file's results could depend on the state left by the previous file
 
 # Set Path for files in support/
 import os
@@ -26,6 +34,8 @@ import io
 import codecs
 import usfm_verses
 import re
+import hashlib
+import json
 if usfmVersion >= 3.0:
     import usfm_utils
 
@@ -167,6 +177,9 @@ def openIssuesFile():
 
 # Writes error message to stderr and to issues.txt.
 def reportError(msg):
+    if collectedIssues is not None:
+        collectedIssues.append(msg)
+        return
     try:
         sys.stderr.write(msg + "\n")
     except UnicodeEncodeError as e:
@@ -348,8 +361,11 @@ def isTextCarryingToken(token):
 def take(token):
     global lastToken
     global usfmVersion
+    global dependsOnLastFile
 
     state = State()
+    if (token.isV() and state.chapter == 0) or (token.isTEXT() and lastToken is None):
+        dependsOnLastFile = True    # paragraph count or last token carried over from the previous file
     if isFootnote(token):
         state.addText()     # footnote replaces need for text
     if state.needText() and not isTextCarryingToken(token) and not suppress1 and not isOptional(state.reference):
@@ -394,35 +410,76 @@ def take(token):
         
     lastToken = token
 
-bad_chapter_re1 = re.compile(r'[^\n\r](\\c\s*\d+)', re.UNICODE)
+# Patterns for verifyChapterAndVerseMarkers(), which only tries them where the text has a \c or \v marker
+marker_re = re.compile(r'\\[cv]')
+chapter_number_re = re.compile(r'\\c\s*\d+', re.UNICODE)
 bad_chapter_re2 = re.compile(r'(\\c[0-9]+)', re.UNICODE)
 bad_chapter_re3 = re.compile(r'(\\c\s*\d+)[^\d\s]+[\n\r]', re.UNICODE)
-bad_verse_re1 = re.compile(r'([^\n\r\s]\\v\s*\d+)', re.UNICODE)
+verse_number_re = re.compile(r'\\v\s*\d+', re.UNICODE)
 bad_verse_re2 = re.compile(r'(\\v[0-9]+)', re.UNICODE)
 bad_verse_re3 = re.compile(r'(\\v\s*[-0-9]+[^-\d\s])', re.UNICODE)
 
 # Receives the text of an entire book as input.
 # Reports bad patterns.
 # Can't report verse references because we haven't started to parse the book yet.
+# Visits each marker once, but reports the same things in the same order as
+#   searching the whole text for each bad pattern in turn.
 def verifyChapterAndVerseMarkers(text, path):
     state = State()
-    for badactor in bad_chapter_re1.finditer(text):
-        reportError(shortname(path) + ": missing newline before chapter marker: " + badactor.group(1))
-    for badactor in bad_chapter_re2.finditer(text):
-        reportError(shortname(path) + ": missing space before chapter number: " + badactor.group(0))
-    for badactor in bad_chapter_re3.finditer(text):
-        reportError(shortname(path) + ": missing space after chapter number: " + badactor.group(1))
-    for badactor in bad_verse_re1.finditer(text):
-        str = badactor.group(1)
-        if str[0] < ' ' or str[0] > '~': # not printable ascii
-            str = str[1:]
+    newlineBeforeChapter = []
+    spaceBeforeChapterNumber = []
+    spaceAfterChapterNumber = []
+    spaceBeforeVerse = []
+    spaceBeforeVerseNumber = []
+    spaceAfterVerseNumber = []
+    # Where the last match of each pattern that can run into the next marker ended,
+    #   since a pattern can't match again inside its own last match
+    newlineBeforeChapterEnd = spaceAfterChapterNumberEnd = spaceBeforeVerseEnd = spaceAfterVerseNumberEnd = 0
+    for marker in marker_re.finditer(text):
+        start = marker.start()
+        if marker.group() == '\\c':
+            if start > newlineBeforeChapterEnd and text[start-1] not in '\n\r':
+                badactor = chapter_number_re.match(text, start)
+                if badactor:
+                    newlineBeforeChapter.append(badactor.group())
+                    newlineBeforeChapterEnd = badactor.end()
+            badactor = bad_chapter_re2.match(text, start)
+            if badactor:
+                spaceBeforeChapterNumber.append(badactor.group(0))
+            if start >= spaceAfterChapterNumberEnd:
+                badactor = bad_chapter_re3.match(text, start)
+                if badactor:
+                    spaceAfterChapterNumber.append(badactor.group(1))
+                    spaceAfterChapterNumberEnd = badactor.end()
+        else:
+            if start > spaceBeforeVerseEnd and not text[start-1].isspace():
+                badactor = verse_number_re.match(text, start)
+                if badactor:
+                    str = text[start-1] + badactor.group()
+                    if str[0] < ' ' or str[0] > '~': # not printable ascii
+                        str = str[1:]
+                    spaceBeforeVerse.append(str)
+                    spaceBeforeVerseEnd = badactor.end()
+            badactor = bad_verse_re2.match(text, start)
+            if badactor:
+                spaceBeforeVerseNumber.append(badactor.group(0))
+            if start >= spaceAfterVerseNumberEnd:
+                badactor = bad_verse_re3.match(text, start)
+                if badactor:
+                    spaceAfterVerseNumber.append(badactor.group(1))
+                    spaceAfterVerseNumberEnd = badactor.end()
+
+    for str in newlineBeforeChapter:
+        reportError(shortname(path) + ": missing newline before chapter marker: " + str)
+    for str in spaceBeforeChapterNumber:
+        reportError(shortname(path) + ": missing space before chapter number: " + str)
+    for str in spaceAfterChapterNumber:
+        reportError(shortname(path) + ": missing space after chapter number: " + str)
+    for str in spaceBeforeVerse:
         reportError(shortname(path) + ": missing space before verse marker: " + str)
-    for badactor in bad_verse_re2.finditer(text):
-        reportError(shortname(path) + ": missing space before verse number: " + badactor.group(0))
-    for badactor in bad_verse_re3.finditer(text):
-        str = badactor.group(1)
-#        if str[-1] < ' ' or str[-1] > '~': # not printable ascii
-#            str = str[:-1]
+    for str in spaceBeforeVerseNumber:
+        reportError(shortname(path) + ": missing space before verse number: " + str)
+    for str in spaceAfterVerseNumber:
         reportError(shortname(path) + ": missing space after verse number: (" + str + ")")
 
 # Corresponding entry point in tx-manager code is verify_contents_quiet()
@@ -433,8 +490,9 @@ def verifyFile(path):
     if usfmVersion >= 3.0:
         str = usfm_utils.usfm3_to_usfm2(str)
 
-    print("CHECKING " + shortname(path))
-    sys.stdout.flush()
+    if collectedIssues is None:
+        print("CHECKING " + shortname(path))
+        sys.stdout.flush()
     verifyChapterAndVerseMarkers(str, path)
     for token in parseUsfm.parseString(str):
         take(token)
@@ -456,12 +514,206 @@ def verifyDir(dirpath):
             elif os.path.isfile(path) and path[-3:].lower() == 'sfm':
                 verifyFile(path)
 
+# Returns the paths of all .usfm files under the specified folder, in the same order as verifyDir().
+def findUsfmFiles(dirpath):
+    paths = []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.name[0] != '.':        # ignore hidden files
+                if entry.is_dir():
+                    paths += findUsfmFiles(entry.path)
+                elif entry.is_file() and entry.path[-3:].lower() == 'sfm':
+                    paths.append(entry.path)
+    return paths
+
+# Runs in a worker process.
+# Checks one file, starting from the state left by the files before it
+# as far as it can be known, and returns its errors instead of reporting them.
+def verifyFileInWorker(path, sourceDir):
+    global source_dir, collectedIssues, dependsOnLastFile, lastToken
+    source_dir = sourceDir
+    collectedIssues = []
+    dependsOnLastFile = False
+    lastToken = None
+    State().addID("")   # in case the last file in this process stopped early
+    State.IDs = []
+    State.errorRefs = set()
+    State.nParagraphs = 0
+    exitCode = None
+    try:
+        verifyFile(path)
+        takenIDs = State.IDs[:-1]   # verifyFile() adds "" at the end
+    except SystemExit as e:
+        exitCode = e.code
+        takenIDs = State.IDs
+    return collectedIssues, takenIDs, State.errorRefs, State.nParagraphs, lastToken, dependsOnLastFile, exitCode
+
+# Yields the results of the futures from verifyFileInWorker(), in order.
+def futureResults(futures):
+    for future in futures:
+        try:
+            yield future.result()
+        except Exception:
+            yield None      # checked again in reportResults() to fail the same way
+
+# Reports the results from verifyFileInWorker() for the files, in order, as verifyDir() would report them.
+# A result is None if checking the file failed.
+# A file is checked again here if its errors might depend on the files before it,
+# e.g., for a duplicate ID, or if checking it failed.
+def reportResults(paths, results):
+    global lastToken
+    for n, (path, result) in enumerate(zip(paths, results)):
+        if result is None:
+            verifyFile(path)
+            continue
+        issues, takenIDs, errorRefs, nParagraphs, finalToken, dependent, exitCode = result
+        if (dependent and n > 0) or set(takenIDs) & set(State.IDs) or errorRefs & State.errorRefs:
+            verifyFile(path)
+            continue
+        print("CHECKING " + shortname(path))
+        sys.stdout.flush()
+        for msg in issues:
+            reportError(msg)
+        State.IDs += takenIDs
+        State.errorRefs |= errorRefs
+        State.nParagraphs = nParagraphs
+        lastToken = finalToken
+        if exitCode is not None:
+            sys.exit(exitCode)
+        State().addID("")
+        sys.stderr.flush()
+
+# Verifies all .usfm files under the specified folder using a pool of processes.
+# The errors are reported in the same order as verifyDir() would report them.
+def verifyDirInParallel(dirpath, nJobs):
+    from concurrent.futures import ProcessPoolExecutor
+    paths = findUsfmFiles(dirpath)
+    with ProcessPoolExecutor(max_workers=nJobs) as executor:
+        futures = [executor.submit(verifyFileInWorker, path, source_dir) for path in paths]
+        reportResults(paths, futureResults(futures))
+
+# Returns the verifyFileInWorker() results for the files, checked in this process or in a pool of processes.
+# Leaves the state as it was before any file was checked.
+def checkFiles(paths, nJobs):
+    global collectedIssues, lastToken
+    if nJobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nJobs) as executor:
+            return list(futureResults([executor.submit(verifyFileInWorker, path, source_dir) for path in paths]))
+    results = []
+    for path in paths:
+        try:
+            results.append(verifyFileInWorker(path, source_dir))
+        except Exception:
+            results.append(None)
+    collectedIssues = None
+    lastToken = None
+    State().addID("")
+    State.IDs = []
+    State.errorRefs = set()
+    State.nParagraphs = 0
+    return results
+
+def fileHash(path):
+    with open(path, 'rb') as input:
+        return hashlib.sha256(input.read()).hexdigest()
+
+# Anything that changes the errors found in an unchanged file makes all the cached results out of date.
+def cacheSettings():
+    modules = [sys.modules[__name__], parseUsfm, usfm_verses]
+    if usfmVersion >= 3.0:
+        modules.append(usfm_utils)
+    return [usfmVersion, suppress1, suppress9] + [fileHash(module.__file__) for module in modules]
+
+# Returns the default cache file for the specified folder, which is kept out of the folder being checked.
+def defaultCachePath(dirpath):
+    name = hashlib.sha256(os.path.abspath(dirpath).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.expanduser('~'), '.cache', 'verifyUSFM', name + '.json')
+
+# Converts a verifyFileInWorker() result to and from something that can be saved as JSON.
+# The last token is kept as its type and value.
+def resultToJson(result):
+    issues, takenIDs, errorRefs, nParagraphs, finalToken, dependent, exitCode = result
+    token = [finalToken.type, finalToken.value] if finalToken else None
+    return [issues, takenIDs, sorted(errorRefs), nParagraphs, token, dependent, exitCode]
+
+def resultFromJson(data):
+    issues, takenIDs, errorRefs, nParagraphs, token, dependent, exitCode = data
+    finalToken = parseUsfm.createToken(token) if token else None
+    return issues, takenIDs, set(errorRefs), nParagraphs, finalToken, dependent, exitCode
+
+# Returns the cached results in the specified file as a dict of file name -> [hash, result],
+# or an empty dict if there are none, or they are for other settings, or the file is not valid.
+def loadCache(path, settings):
+    try:
+        with io.open(path, "tr", encoding="utf-8") as input:
+            cache = json.load(input)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('settings') != settings or not isinstance(cache.get('files'), dict):
+        return {}
+    entries = {}
+    for name, entry in cache['files'].items():
+        try:
+            hash, data = entry
+            entries[name] = [hash, resultFromJson(data)]
+        except Exception:
+            pass    # checked again
+    return entries
+
+# Verifies all .usfm files under the specified folder, only checking the files that changed since the last run.
+# Keeps a manifest of the hash of each file and its results in the JSON file at cachePath,
+# or in ~/.cache/verifyUSFM if that is None (never in the folder itself).
+# All of the results are then reported, as verifyDir() would report them,
+# so the checks that depend on more than one file (e.g., duplicate IDs) are still made.
+def verifyDirIncrementally(dirpath, nJobs, cachePath=None):
+    paths = findUsfmFiles(dirpath)
+    if not cachePath:
+        cachePath = defaultCachePath(dirpath)
+    settings = cacheSettings()
+    entries = loadCache(cachePath, settings)
+    hashes = {path: fileHash(path) for path in paths}
+    changed = [path for path in paths if entries.get(shortname(path), (None, None))[0] != hashes[path]]
+    for path, result in zip(changed, checkFiles(changed, nJobs)):
+        if result is None:
+            entries.pop(shortname(path), None)
+        else:
+            entries[shortname(path)] = [hashes[path], result]
+    files = {shortname(path): [entries[shortname(path)][0], resultToJson(entries[shortname(path)][1])]
+             for path in paths if shortname(path) in entries}
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cachePath)), exist_ok=True)
+        tempPath = cachePath + ".tmp"
+        with io.open(tempPath, "tw", encoding="utf-8") as output:
+            json.dump({'settings': settings, 'files': files}, output)
+        os.replace(tempPath, cachePath)
+    except OSError as e:
+        sys.stderr.write("Unable to save " + cachePath + ": " + str(e) + "\n")
+    reportResults(paths, [entries[shortname(path)][1] if shortname(path) in entries else None for path in paths])
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] != 'hard-coded-path':
-        source_dir = sys.argv[1]
+    args = sys.argv[1:]
+    if '--jobs' in args:
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    if '--incremental' in args:
+        incremental = True
+        args.remove('--incremental')
+    if '--cache' in args:
+        i = args.index('--cache')
+        cachePath = args[i + 1]
+        del args[i:i + 2]
+    if len(args) > 0 and args[0] != 'hard-coded-path':
+        source_dir = args[0]
     
     if os.path.isdir(source_dir):
-        verifyDir(source_dir)
+        if incremental:
+            verifyDirIncrementally(source_dir, jobs, cachePath)
+        elif jobs > 1:
+            verifyDirInParallel(source_dir, jobs)
+        else:
+            verifyDir(source_dir)
     elif os.path.isfile(source_dir):
         path = source_dir
         source_dir = os.path.dirname(path)
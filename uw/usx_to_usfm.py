@@ -11,26 +11,290 @@
 
 '''
 Converts a given USX file to USFM. This is a work in progress, supporting the tags that transationStudio used for USX.
+
+The USX is read with iterparse() and each USFM marker is written out as soon as its element is reached,
+clearing the elements that are done with, so memory stays flat however big the book is.
+Files that aren't well-formed XML (e.g., tStudio chunks that split a paragraph) just have their verse tags converted.
+
+Usage: usx_to_usfm.py </path/to/file>
+       usx_to_usfm.py --dir [--jobs N] </path/to/usx/folder> </path/to/usfm/folder>
+           (converts N files at once, default is the number of CPUs)
 '''
 
-import sys
+from __future__ import print_function, unicode_literals
+
+import io
+import os
 import re
+import sys
+from xml.etree.ElementTree import iterparse, ParseError
+
+verse_re = re.compile(r'<verse number="(\d+)" style="v" />')
+newline_space_re = re.compile(r'\s*\n\s*')
+
+# Character styles of footnotes and cross references that don't need an end marker
+note_char_styles = {'fr', 'fk', 'fl', 'fw', 'fp', 'fq', 'fqa', 'fqb', 'ft', 'xo', 'xk', 'xq', 'xt', 'xta'}
+
+
+class UsxReader(object):
+    '''
+    Chains a few strings and an open file into one file-like object for iterparse(),
+    e.g., to wrap a tStudio chunk (which has no root element) in a <usx> element.
+    '''
+    def __init__(self, *parts):
+        self.parts = list(parts)
+
+    def read(self, size=-1):
+        while self.parts:
+            part = self.parts[0]
+            if hasattr(part, 'read'):
+                data = part.read(size)
+                if data:
+                    return data
+            else:
+                data = part
+            self.parts.pop(0)
+            if data:
+                return data
+        return b''
+
+
+class UsfmWriter(object):
+    '''
+    Writes the USFM for the start and end of each USX element to an open text file.
+    '''
+    def __init__(self, output):
+        self.output = output
+        self.started = False
+        self.space = ''         # whitespace held back until we know it isn't at the end of a line
+        self.chars = []         # styles of the open <char> elements
+        self.in_note = False
+
+    def write(self, t):
+        if t:
+            self.output.write('' + t)
+            self.started = True
+
+    def text(self, t):
+        if not t:
+            return
+        t = newline_space_re.sub(' ', t)
+        if self.space:
+            t = t.lstrip()
+        body = t.rstrip()
+        if body:
+            self.write(self.space + body)
+            self.space = t[len(body):]
+        elif t:
+            self.space = ' '
+
+    def marker(self, m):
+        self.write(self.space + m)
+        self.space = ''
+
+    def newline_marker(self, m):
+        '''
+        Starts a new line with the marker (and holds back the space after it)
+        '''
+        self.write('\n' + m if self.started else m)
+        self.space = ' '
+
+    def start(self, elem):
+        tag = elem.tag
+        style = elem.get('style', '')
+        if tag == 'book':
+            self.newline_marker('\\id ' + elem.get('code', ''))
+        elif tag == 'chapter':
+            if elem.get('number'):
+                self.newline_marker('\\c ' + elem.get('number'))
+        elif tag == 'verse':
+            if elem.get('number'):
+                self.newline_marker('\\v ' + elem.get('number'))
+        elif tag == 'para' or tag == 'row':
+            self.newline_marker('\\' + style)
+        elif tag == 'cell':
+            self.marker('\\' + style + ' ')
+        elif tag == 'note':
+            self.in_note = True
+            self.marker('\\' + style + ' ' + elem.get('caller', '+') + ' ')
+        elif tag == 'char':
+            self.marker('\\' + ('+' if self.chars else '') + style + ' ')
+            self.chars.append(style)
+        elif tag == 'optbreak':
+            self.marker('//')
+        elif tag == 'figure':
+            self.marker('\\fig ')
+
+    def end(self, elem):
+        tag = elem.tag
+        style = elem.get('style', '')
+        if tag == 'para' or tag == 'row' or tag == 'book':
+            self.space = ''
+        elif tag == 'note':
+            self.in_note = False
+            self.marker('\\' + style + '*')
+        elif tag == 'char':
+            self.chars.pop()
+            attributes = [(k, v) for k, v in elem.attrib.items() if k not in ('style', 'closed')]
+            if attributes:
+                self.marker('|' + ' '.join('{0}="{1}"'.format(k, v) for k, v in attributes))
+            closed = elem.get('closed')
+            if closed == 'true' or (closed != 'false' and not (self.in_note and style in note_char_styles)):
+                self.marker('\\' + ('+' if self.chars else '') + style + '*')
+        elif tag == 'figure':
+            self.marker('|' + elem.get('src', '') + '\\fig*')
+
+    def close(self):
+        self.output.write('\n')
 
-def convert(filepath):
-    newcontent = '';
 
-    with open(filepath) as f:
+def convert_xml(source, output):
+    '''
+    Writes the USFM for the USX in source (a path or a binary file object) to output
+    :return: False if the USX isn't well-formed XML (in which case part of the USFM may have been written)
+    '''
+    writer = UsfmWriter(output)
+    stack = []
+    done = None     # an element whose tail is still to be written
+    try:
+        for event, elem in iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if done is not None:
+                    writer.text(done.tail)
+                    stack[-1].remove(done)
+                    done = None
+                elif stack:
+                    writer.text(stack[-1].text)
+                writer.start(elem)
+                stack.append(elem)
+            else:
+                if done is not None:
+                    writer.text(done.tail)
+                    done = None
+                else:
+                    writer.text(elem.text)
+                writer.end(elem)
+                del elem[:]     # its tail is still needed, so it's removed from its parent once that's written
+                stack.pop()
+                done = elem if stack else None
+    except ParseError:
+        return False
+    writer.close()
+    return True
+
+
+def convert_verses(filepath):
+    '''
+    The original conversion, which just converts the verse tags
+    '''
+    newcontent = ''
+
+    with io.open(filepath, encoding='utf-8') as f:
         for line in f:
-            newcontent += re.sub(r'<verse number="(\d+)" style="v" />', '\\\\v \g<1> ', line)
+            newcontent += verse_re.sub('\\\\v \\g<1> ', line)
     return newcontent
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print "Usage: usx_to_usfm.py </path/to/file>"
-        exit(1)
 
-    filepath = sys.argv[1]
+def has_only_verse_tags(filepath):
+    '''
+    :return: True if the file has no tags but tStudio's verse tags, which convert_verses() handles
+    '''
+    with io.open(filepath, encoding='utf-8') as f:
+        for line in f:
+            if '<' in verse_re.sub('', line):
+                return False
+    return True
+
+
+def convert_file(filepath, output):
+    '''
+    Writes the USFM for the USX file to output (an open text file)
+    '''
+    with io.open(filepath, 'rb') as f:
+        is_document = f.read(200).lstrip(b'\xef\xbb\xbf \t\r\n').startswith((b'<?xml', b'<usx'))
+    if not is_document and has_only_verse_tags(filepath):
+        # A chunk of text and verse tags converts as it always has, keeping its own lines and spacing
+        output.write(convert_verses(filepath))
+        return
+    with io.open(filepath, 'rb') as f:
+        source = f if is_document else UsxReader(b'<usx>', f, b'</usx>')
+        if convert_xml(source, output):
+            return
+    if hasattr(output, 'seek'):
+        output.seek(0)
+        output.truncate()
+    output.write(convert_verses(filepath))
 
-    print convert(filepath)
 
+def convert(filepath):
+    output = io.StringIO()
+    convert_file(filepath, output)
+    return output.getvalue()
+
+
+def convert_to_file(paths):
+    '''
+    Converts one USX file to a USFM file. Runs in a worker process with --dir.
+    :return: an error message, or None if it was converted
+    '''
+    usx_path, usfm_path = paths
+    try:
+        with io.open(usfm_path + '.tmp', 'w+', encoding='utf-8', newline='\n') as output:
+            convert_file(usx_path, output)
+        if os.path.exists(usfm_path):
+            os.remove(usfm_path)
+        os.rename(usfm_path + '.tmp', usfm_path)
+    except Exception as e:
+        if os.path.exists(usfm_path + '.tmp'):
+            os.remove(usfm_path + '.tmp')
+        return 'Unable to convert {0}: {1!r}'.format(usx_path, e)
+    return None
+
+
+def convert_dir(usx_dir, usfm_dir, jobs):
+    '''
+    Converts every .usx file in usx_dir to a .usfm file in usfm_dir, jobs files at once
+    '''
+    if not os.path.isdir(usfm_dir):
+        os.makedirs(usfm_dir)
+    paths = [(os.path.join(usx_dir, name), os.path.join(usfm_dir, os.path.splitext(name)[0] + '.usfm'))
+             for name in sorted(os.listdir(usx_dir)) if name.lower().endswith('.usx')]
+    if jobs > 1 and len(paths) > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        try:
+            errors = pool.map(convert_to_file, paths, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [convert_to_file(p) for p in paths]
+    for (usx_path, usfm_path), error in zip(paths, errors):
+        if error:
+            print(error, file=sys.stderr)
+        else:
+            print('{0} => {1}'.format(usx_path, usfm_path))
+    return not any(errors)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--dir':
+        args.pop(0)
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+        if args and args[0] == '--jobs':
+            jobs = int(args[1])
+            args = args[2:]
+        if len(args) < 2:
+            print('Usage: usx_to_usfm.py --dir [--jobs N] </path/to/usx/folder> </path/to/usfm/folder>')
+            exit(1)
+        exit(0 if convert_dir(args[0], args[1], jobs) else 1)
+
+    if len(args) < 1:
+        print('Usage: usx_to_usfm.py </path/to/file>')
+        exit(1)
+
+    filepath = args[0]
 
+    print(convert(filepath))